@@ -8,5 +8,5 @@ from . import datasets
 from . import layers
 from . import models
 from .databases import EmailDatabase
-from .parser import parse
-from .sources import GmailSource
+from .parser import parse, parse_email, ParsedEmail
+from .sources import GmailSource, MailboxSource
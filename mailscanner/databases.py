@@ -2,37 +2,727 @@
 Adapters to store an individual user's email in a database.
 '''
 
-import os
+import collections
+import email.utils
+import hashlib
+import itertools
+import pickle
 import sqlite3
+import zlib
 
 from tqdm import tqdm
 
+from .parser import parse_message
+
+# rows written per transaction by the bulk save methods
+BATCH_SIZE = 10000
+
+# write ahead logging lets readers, say building a dataset, run alongside a download
+# and with that, a full fsync on every commit is not needed to stay consistent
+PRAGMAS = '''
+pragma journal_mode = wal;
+pragma synchronous = normal;
+pragma temp_store = memory;
+pragma cache_size = -65536;
+'''
+
+# rows pulled from SQLite at a time when scanning
+CHUNK_SIZE = 1024
+
+# columns of an email table that can be scanned, a body is stored inline or in `bodies`
+COLUMNS = {
+    'rowid': '{0}.rowid',
+    'id': '{0}.id',
+    'body_key': '{0}.body_key',
+    'body': 'coalesce({0}.body, bodies.body)',
+    # true when a sent email is in reply to this one
+    'replied': '''exists (
+        select 1 from header_index received
+        join header_index reply on reply.in_reply_to = received.message_id and reply.source = 'sent_email'
+        where received.source = '{0}' and received.id = {0}.id)''',
+}
+
+# headers extracted to `header_index` as emails are stored
+INDEXED_HEADERS = ['message_id', 'in_reply_to', 'refs', 'date', 'sender', 'recipients']
+
+
+def indexed_headers(message):
+    '''
+    Values for `INDEXED_HEADERS` from a parsed email.
+
+    >>> indexed_headers(parse_message(b'Message-ID: <2@example.com>\\r\\nIn-Reply-To: <1@example.com>\\r\\n', headers_only=True))
+    ('<2@example.com>', '<1@example.com>', None, None, None, None)
+    '''
+    def header(name):
+        value = message.get(name)
+        return str(value).strip() if value is not None else None
+    date = header('Date')
+    try:
+        date = int(email.utils.parsedate_to_datetime(date).timestamp()) if date else None
+    except (TypeError, ValueError):
+        date = None
+    return (header('Message-ID'), header('In-Reply-To'), header('References'),
+            date, header('From'), header('To'))
+
+
+def body_key(body, message=None):
+    '''
+    Content address of an email. This is the Message-ID when there is one, which is
+    the same in every folder holding the email, otherwise a hash of the bytes.
+
+    >>> body_key(b'Message-ID: <1@example.com>\\r\\n\\r\\nHello')
+    '<1@example.com>'
+    >>> body_key(b'Subject: no identifier\\r\\n\\r\\nHello')[:5]
+    'sha1:'
+    '''
+    if message is None:
+        message = parse_message(body, headers_only=True)
+    message_id = message.get('Message-ID')
+    if message_id and str(message_id).strip():
+        return str(message_id).strip()
+    return 'sha1:' + hashlib.sha1(body).hexdigest()
+
+
+def keyed_bodies(rows, codec):
+    '''
+    Key, index and compress email bodies, all the work of storing them short of
+    writing, see `EmailDatabase.save_keyed`. This needs no database, so it can
+    run in other processes.
+
+    >>> keyed = keyed_bodies([('1', b'Message-ID: <1@example.com>\\r\\n\\r\\nHello')], ZlibCodec())
+    >>> identifier, key, body, headers = keyed[0]
+    >>> key, ZlibCodec().decompress(body), headers[0]
+    ('<1@example.com>', b'Message-ID: <1@example.com>\\r\\n\\r\\nHello', '<1@example.com>')
+
+    Parameters
+    ----------
+    rows
+        An iterable of (identifier, body) tuples, bodies are RFC822 bytes or text.
+    codec
+        The body codec of the database the rows are for.
+
+    Returns
+    -------
+    list
+        A list of (identifier, body key, compressed body, indexed headers) tuples.
+    '''
+    keyed = []
+    for identifier, body in rows:
+        if isinstance(body, str):
+            body = body.encode('utf8')
+        message = parse_message(body, headers_only=True)
+        keyed.append((identifier, body_key(body, message), codec.compress(body), indexed_headers(message)))
+    return keyed
+
+
+class ZlibCodec:
+    '''
+    Compress email bodies with zlib.
+
+    Optionally, the compressor is primed with a preset dictionary of text
+    common to most email, which helps a great deal on small emails, see `train`.
+
+    >>> codec = ZlibCodec()
+    >>> codec.decompress(codec.compress(b'Subject: hello'))
+    b'Subject: hello'
+    '''
+
+    def __init__(self, level=6, dictionary=None):
+        '''
+        Parameters
+        ----------
+        level
+            zlib compression level, 1 is fastest, 9 is smallest.
+        dictionary
+            Optional preset dictionary bytes.
+        '''
+        self.level = level
+        self.dictionary = dictionary
+
+    def compress(self, data):
+        '''
+        Compress bytes.
+        '''
+        if self.dictionary:
+            compressor = zlib.compressobj(self.level, zdict=self.dictionary)
+        else:
+            compressor = zlib.compressobj(self.level)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data):
+        '''
+        Decompress bytes from `compress`.
+        '''
+        if self.dictionary:
+            decompressor = zlib.decompressobj(zdict=self.dictionary)
+        else:
+            decompressor = zlib.decompressobj()
+        return decompressor.decompress(data) + decompressor.flush()
+
+    @classmethod
+    def train(cls, samples, size=32 * 1024, level=6):
+        '''
+        Build a codec with a preset dictionary of the lines most often repeated
+        across sample emails, think common headers and signatures.
+
+        Parameters
+        ----------
+        samples
+            An iterable of email bytes.
+        size
+            Largest dictionary in bytes, zlib will only use the last 32KB.
+        level
+            zlib compression level.
+        '''
+        counts = collections.Counter()
+        for sample in samples:
+            counts.update(set(sample.splitlines(keepends=True)))
+        dictionary = b''
+        # zlib looks back from the end of the dictionary, most common lines go last
+        for line, count in counts.most_common():
+            if count < 2 or len(dictionary) + len(line) > size:
+                break
+            dictionary = line + dictionary
+        return cls(level=level, dictionary=dictionary or None)
+
 
 class EmailDatabase(sqlite3.Connection):
     '''
     Store email in raw RFC822 format with identifiers.
+
+    Writes go through the bulk `save_` methods, which batch many rows per
+    transaction. Any number of other connections to the same file can read
+    while a download writes.
+
+    Bodies are the original RFC822 bytes, compressed by a codec that is saved
+    in the database, and are decompressed to text when visited. Databases from
+    before compression keep working, and `recompress` will shrink them.
+
+    Each body is stored once in the `bodies` table, addressed by `body_key`, and
+    the folder tables refer to it, so email that is in more than one folder, like
+    sent email that is also in all mail, is not stored twice.
+
+    Key headers, see `INDEXED_HEADERS`, are extracted into `header_index` as
+    email is stored, so finding replies is a query, not a parse of every email.
+
+    Attributes
+    ----------
+    codec
+        Compresses and decompresses bodies, say a `ZlibCodec`.
+    filename
+        Where the database is on disk, so other processes can open it too.
     '''
 
-    def __init__(self, database_filename):
+    def __init__(self, database_filename, timeout=60.0, codec=None):
         '''
         Parameters
         ----------
         database_filename
             A string, where to store the file on disk. The folder must exist.
+        timeout
+            Seconds to wait on another connection holding a lock before giving up.
+        codec
+            Body codec for a new database, any object with `compress` and `decompress`
+            methods for bytes. Defaults to the codec saved in the database, or `ZlibCodec`.
+        '''
+        # tables are created if missing, so older databases pick up new tables
+        creation_query = '''
+        create table if not exists all_email(id text, body text, body_key text);
+        create unique index if not exists all_email_id on all_email(id);
+        create table if not exists sent_email(id text, body text, body_key text);
+        create unique index if not exists sent_email_id on sent_email(id);
+        create table if not exists bodies(body_key text primary key, body blob);
+        create table if not exists sync_state(folder text primary key, uidvalidity integer, last_uid integer, modseq integer);
+        create table if not exists email_headers(source text, id text, headers text);
+        create unique index if not exists email_headers_id on email_headers(source, id);
+        create table if not exists settings(name text primary key, value blob);
+        create table if not exists header_index(
+            source text, id text, body_key text,
+            message_id text, in_reply_to text, refs text, date integer, sender text, recipients text);
+        create unique index if not exists header_index_id on header_index(source, id);
+        create index if not exists header_index_body_key on header_index(body_key);
+        create index if not exists header_index_message_id on header_index(message_id);
+        create index if not exists header_index_in_reply_to on header_index(in_reply_to);
         '''
-        if not os.path.exists(database_filename):
-            creation_query = '''
-            create table all_email(id text, body text);
-            create unique index all_email_id on all_email(id);
-            create table sent_email(id text, body text);
-            create unique index sent_email_id on sent_email(id);
-            '''
+        super(EmailDatabase, self).__init__(database_filename, timeout=timeout)
+        self.filename = database_filename
+        self.executescript(PRAGMAS)
+        self.executescript(creation_query)
+        for table in ['all_email', 'sent_email']:
+            columns = [row[1] for row in self.execute('pragma table_info({0})'.format(table))]
+            if 'body_key' not in columns:
+                self.execute('alter table {0} add column body_key text'.format(table))
+            self.execute('create index if not exists {0}_body_key on {0}(body_key)'.format(table))
+        self.commit()
+        saved = self.execute('select value from settings where name = ?', ('codec',)).fetchone()
+        if saved and codec and pickle.dumps(codec) != saved[0]:
+            raise ValueError('database has a different codec, use recompress to change it')
+        if saved:
+            self.codec = pickle.loads(saved[0])
         else:
-            creation_query = None
-        super(EmailDatabase, self).__init__(database_filename)
-        if creation_query:
-            self.executescript(creation_query)
+            self._save_codec(codec or ZlibCodec())
+
+    def _save_codec(self, codec):
+        '''
+        Remember the body codec in the database itself.
+        '''
+        self.codec = codec
+        self.execute('''
+            insert or replace into settings (name, value)
+            values (?, ?)
+        ''', ('codec', pickle.dumps(codec)))
+        self.commit()
 
+    def encode(self, body):
+        '''
+        Compress an email body for storage.
+
+        Parameters
+        ----------
+        body
+            RFC822 bytes, or text which is stored as UTF-8.
+        '''
+        if isinstance(body, str):
+            body = body.encode('utf8')
+        return self.codec.compress(body)
+
+    def decode(self, body, raw=False):
+        '''
+        Decompress a stored email body. Bodies stored as text, before compression,
+        are passed through.
+
+        Parameters
+        ----------
+        body
+            A stored body.
+        raw
+            Return the original bytes, rather than text.
+        '''
+        if isinstance(body, bytes):
+            body = self.codec.decompress(body)
+            return body if raw else body.decode('utf8', errors='replace')
+        return body.encode('utf8') if raw else body
+
+    def recompress(self, codec=None, verbose=True):
+        '''
+        Rewrite every body with a new codec, compressing any bodies stored as text.
+
+        This is a single transaction, so a database is never left with a mix
+        of codecs.
+
+        Parameters
+        ----------
+        codec
+            The new codec, by default one trained on a sample of stored email,
+            see `ZlibCodec.train`.
+        '''
+        if codec is None:
+            sample = self.execute('''
+                select body from (
+                    select body from bodies
+                    union all
+                    select body from all_email
+                    where body is not null)
+                order by random() limit 1024
+            ''').fetchall()
+            codec = ZlibCodec.train(self.decode(row[0], raw=True) for row in sample)
+        with self:
+            for table in ['bodies', 'all_email', 'sent_email']:
+                count = self.execute('select count(*) from {0} where body is not null'.format(table)).fetchone()[0]
+                progress = tqdm(total=count, desc=table, unit='email', disable=(not verbose))
+                last = 0
+                while True:
+                    # a page at a time, by rowid, rather than updating under an open select
+                    rows = self.execute('''
+                        select rowid, body from {0}
+                        where body is not null and rowid > ?
+                        order by rowid limit ?
+                    '''.format(table), (last, BATCH_SIZE)).fetchall()
+                    if not rows:
+                        break
+                    self.executemany('''
+                        update {0}
+                        set body = ?
+                        where rowid = ?
+                    '''.format(table), [(codec.compress(self.decode(body, raw=True)), rowid) for rowid, body in rows])
+                    last = rows[-1][0]
+                    progress.update(len(rows))
+                progress.close()
+            self.execute('''
+                insert or replace into settings (name, value)
+                values (?, ?)
+            ''', ('codec', pickle.dumps(codec)))
+        self.codec = codec
+
+    def _batches(self, rows, batch_size=BATCH_SIZE):
+        '''
+        Split an iterable into lists of at most `batch_size`.
+        '''
+        rows = iter(rows)
+        while True:
+            batch = list(itertools.islice(rows, batch_size))
+            if not batch:
+                break
+            yield batch
+
+    def _save(self, query, rows, batch_size=BATCH_SIZE):
+        '''
+        Execute a query over many rows, committing once per batch.
+        '''
+        for batch in self._batches(rows, batch_size):
+            with self:
+                self.executemany(query, batch)
+
+    def save_identifiers(self, table, identifiers, batch_size=BATCH_SIZE):
+        '''
+        Store email identifiers, without bodies. Identifiers already stored are ignored.
+
+        Parameters
+        ----------
+        table
+            The email table name, say 'all_email'.
+        identifiers
+            An iterable of email identification strings.
+        batch_size
+            Rows written per transaction.
+        '''
+        query = '''
+            insert or ignore into {0} (id, body)
+            values (?, null)
+        '''.format(table)
+        self._save(query, ((identifier,) for identifier in identifiers), batch_size)
+
+    def save_bodies(self, table, rows, batch_size=BATCH_SIZE):
+        '''
+        Store email bodies for identifiers already stored. A body already stored
+        for another identifier, or in another table, is referred to, not stored again.
+
+        Parameters
+        ----------
+        table
+            The email table name, say 'all_email'.
+        rows
+            An iterable of (identifier, body) tuples, bodies are RFC822 bytes.
+        batch_size
+            Rows written per transaction.
+        '''
+        for batch in self._batches(rows, batch_size):
+            self.save_keyed(table, keyed_bodies(batch, self.codec))
+
+    def save_keyed(self, table, keyed):
+        '''
+        Store email bodies already keyed, indexed and compressed by `keyed_bodies`,
+        in a single transaction. This is just the writing half of `save_bodies`.
+
+        Parameters
+        ----------
+        table
+            The email table name, say 'all_email'.
+        keyed
+            A list of tuples from `keyed_bodies`, compressed with this database's codec.
+        '''
+        known = self.known_bodies([key for _, key, _, _ in keyed])
+        with self:
+            self.executemany('''
+                insert or ignore into bodies (body_key, body)
+                values (?, ?)
+            ''', [(key, body) for _, key, body, _ in keyed if key not in known])
+            self.executemany('''
+                update {0}
+                set body = null, body_key = ?
+                where id = ?
+            '''.format(table), [(key, identifier) for identifier, key, _, _ in keyed])
+            self._index(table, [(identifier, key) + headers for identifier, key, _, headers in keyed])
+
+    def _index(self, source, rows):
+        '''
+        Store extracted headers, rows are (identifier, body key) followed by `INDEXED_HEADERS`.
+        '''
+        self.executemany('''
+            insert or replace into header_index (source, id, body_key, {0})
+            values (?, ?, ?, {1})
+        '''.format(', '.join(INDEXED_HEADERS), ', '.join('?' * len(INDEXED_HEADERS))),
+            [(source,) + row for row in rows])
+
+    def index_headers(self, verbose=True):
+        '''
+        Extract headers into `header_index` for any stored email that is missing there,
+        say in a database from before the index. This is a no-op once all email is indexed.
+        '''
+        for table in ['all_email', 'sent_email']:
+            where = ('''not exists (
+                select 1 from header_index
+                where header_index.source = ? and header_index.id = {0}.id)'''.format(table), table)
+            progress = tqdm(total=self.count(table, where=where), desc=table, unit='email', disable=(not verbose))
+            start = None
+            while True:
+                # a page at a time, rather than writing under an open select
+                rows = list(itertools.islice(
+                    self.emails(table, columns=('rowid', 'id', 'body_key', 'body'), start=start, where=where, raw=True),
+                    BATCH_SIZE))
+                if not rows:
+                    break
+                with self:
+                    self._index(table, [(identifier, key) + indexed_headers(parse_message(body, headers_only=True))
+                                        for _, identifier, key, body in rows])
+                start = rows[-1][0] + 1
+                progress.update(len(rows))
+            progress.close()
+        where = '''not exists (
+            select 1 from header_index
+            where header_index.source = email_headers.source and header_index.id = email_headers.id)'''
+        rows = self.execute('select source, id, headers from email_headers where {0}'.format(where)).fetchall()
+        with self:
+            for source, identifier, headers in rows:
+                self._index(source, [(identifier, None) + indexed_headers(parse_message(headers.encode('utf8'), headers_only=True))])
+
+    def save_keys(self, table, rows, batch_size=BATCH_SIZE):
+        '''
+        Refer identifiers to bodies already stored, see `known_bodies`.
+
+        Parameters
+        ----------
+        table
+            The email table name, say 'all_email'.
+        rows
+            An iterable of (identifier, body key) tuples.
+        batch_size
+            Rows written per transaction.
+        '''
+        for batch in self._batches(rows, batch_size):
+            with self:
+                self.executemany('''
+                    update {0}
+                    set body_key = ?
+                    where id = ?
+                '''.format(table), [(key, identifier) for identifier, key in batch])
+                # the same email, so the same headers, as already indexed
+                self.executemany('''
+                    insert or replace into header_index (source, id, body_key, {0})
+                    select ?, ?, body_key, {0} from header_index
+                    where body_key = ? limit 1
+                '''.format(', '.join(INDEXED_HEADERS)), [(table, identifier, key) for identifier, key in batch])
+
+    def known_bodies(self, keys):
+        '''
+        Which bodies are already stored.
+
+        Parameters
+        ----------
+        keys
+            An iterable of body keys, see `body_key`.
+
+        Returns
+        -------
+        set
+            The keys with a stored body.
+        '''
+        known = set()
+        # stay well under the SQLite limit on query parameters
+        for batch in self._batches(keys, 512):
+            known.update(row[0] for row in self.execute('''
+                select body_key from bodies
+                where body_key in ({0})
+            '''.format(','.join('?' * len(batch))), batch))
+        return known
+
+    def has_bodies(self):
+        '''
+        True when any body is stored in the shared `bodies` table.
+        '''
+        return self.execute('select exists (select 1 from bodies)').fetchone()[0] == 1
+
+    def save_headers(self, source, rows, batch_size=BATCH_SIZE):
+        '''
+        Store headers of emails downloaded as headers only.
+
+        Parameters
+        ----------
+        source
+            The email table name the headers were downloaded for, say 'sent_email'.
+        rows
+            An iterable of (identifier, headers) tuples, headers are bytes or text.
+        batch_size
+            Rows written per transaction.
+        '''
+        for batch in self._batches(rows, batch_size):
+            batch = [(identifier, headers.encode('utf8') if isinstance(headers, str) else headers)
+                     for identifier, headers in batch]
+            with self:
+                self.executemany('''
+                    insert or replace into email_headers (source, id, headers)
+                    values (?, ?, ?)
+                ''', [(source, identifier, headers.decode('utf8', errors='replace')) for identifier, headers in batch])
+                self._index(source, [(identifier, None) + indexed_headers(parse_message(headers, headers_only=True))
+                                     for identifier, headers in batch])
+
+    def missing_bodies(self, table):
+        '''
+        Identifiers stored without a body.
+
+        Returns
+        -------
+        list
+            A list of email identification strings.
+        '''
+        cursor = self.cursor()
+        cursor.execute('''
+            select id from {0}
+            where body is null and body_key is null
+        '''.format(table))
+        return [row[0] for row in cursor.fetchall()]
+
+    def missing_headers(self, source):
+        '''
+        Identifiers stored without either a body or downloaded headers.
+
+        Returns
+        -------
+        list
+            A list of email identification strings.
+        '''
+        cursor = self.cursor()
+        cursor.execute('''
+            select id from {0}
+            where body is null and body_key is null and not exists (
+                select 1 from email_headers
+                where email_headers.source = ? and email_headers.id = {0}.id)
+        '''.format(source), (source,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def clear(self, table):
+        '''
+        Forget all email stored in a table.
+        '''
+        with self:
+            self.execute('delete from {0}'.format(table))
+            self.execute('delete from email_headers where source = ?', (table,))
+            self.execute('delete from header_index where source = ?', (table,))
+            # bodies no longer referred to from any table
+            self.execute('''
+                delete from bodies
+                where not exists (select 1 from all_email where all_email.body_key = bodies.body_key)
+                and not exists (select 1 from sent_email where sent_email.body_key = bodies.body_key)
+            ''')
+
+    def sync_state(self, folder):
+        '''
+        Where the last download of a folder left off.
+
+        Parameters
+        ----------
+        folder
+            A string naming the IMAP folder.
+
+        Returns
+        -------
+        tuple
+            (uidvalidity, last_uid, modseq), or `None` if the folder has never been synced.
+        '''
+        cursor = self.cursor()
+        cursor.execute('''
+            select uidvalidity, last_uid, modseq from sync_state
+            where folder = ?
+        ''', (folder,))
+        return cursor.fetchone()
+
+    def save_sync_state(self, folder, uidvalidity, last_uid, modseq):
+        '''
+        Record where a download of a folder left off.
+
+        Parameters
+        ----------
+        folder
+            A string naming the IMAP folder.
+        uidvalidity
+            The folder UIDVALIDITY, identifiers are only comparable while this is unchanged.
+        last_uid
+            The highest identifier stored.
+        modseq
+            The folder HIGHESTMODSEQ, or `None` when the server lacks CONDSTORE.
+        '''
+        with self:
+            self.execute('''
+                insert or replace into sync_state (folder, uidvalidity, last_uid, modseq)
+                values (?, ?, ?, ?)
+            ''', (folder, uidvalidity, last_uid, modseq))
+
+    def _scan(self, table, start, stop, where):
+        '''
+        The from and where clauses, with parameters, shared by `emails` and `count`.
+        '''
+        clauses = ['({0}.body is not null or {0}.body_key is not null)'.format(table)]
+        parameters = []
+        if start is not None:
+            clauses.append('{0}.rowid >= ?'.format(table))
+            parameters.append(start)
+        if stop is not None:
+            clauses.append('{0}.rowid < ?'.format(table))
+            parameters.append(stop)
+        if where:
+            clauses.append('({0})'.format(where[0]))
+            parameters.extend(where[1:])
+        query = '''
+            from {0}
+            left join bodies on bodies.body_key = {0}.body_key
+            where {1}
+        '''.format(table, ' and '.join(clauses))
+        return query, parameters
+
+    def emails(self, table, columns=('body',), start=None, stop=None, where=None, raw=False, chunk_size=CHUNK_SIZE):
+        '''
+        Iterate over stored emails, in the order they were stored, pulling rows
+        from SQLite a chunk at a time, so memory use does not grow with the table.
+
+        >>> database = EmailDatabase(':memory:')
+        >>> database.save_identifiers('all_email', ['1', '2'])
+        >>> database.save_bodies('all_email', [('1', b'Subject: one'), ('2', b'Subject: two')])
+        >>> list(database.emails('all_email', columns=('id', 'body'), where=('all_email.id > ?', '1')))
+        [('2', 'Subject: two')]
+
+        Parameters
+        ----------
+        table
+            The email table name, say 'all_email'.
+        columns
+            Names of the columns to project, any of 'rowid', 'id', 'body_key', 'body'.
+        start
+            Begin at this rowid, say to resume a scan.
+        stop
+            End before this rowid.
+        where
+            An additional SQL condition, with any parameters following it in a tuple,
+            say `('all_email.id > ?', '100')`.
+        raw
+            Return bodies as the original bytes, rather than text.
+        chunk_size
+            Rows pulled from SQLite at a time.
+
+        Returns
+        -------
+        generator
+            Yields a tuple of the projected columns for each email, bodies decompressed.
+        '''
+        query, parameters = self._scan(table, start, stop, where)
+        projection = ', '.join(COLUMNS[column].format(table) for column in columns)
+        body = columns.index('body') if 'body' in columns else None
+        cursor = self.cursor()
+        cursor.execute('select {0} {1} order by {2}.rowid'.format(projection, query, table), parameters)
+        while True:
+            rows = cursor.fetchmany(chunk_size)
+            if not rows:
+                break
+            for row in rows:
+                if body is not None:
+                    row = row[:body] + (self.decode(row[body], raw=raw),) + row[body + 1:]
+                yield row
+
+    def count(self, table, start=None, stop=None, where=None):
+        '''
+        Number of emails `emails` will visit with the same parameters.
+        '''
+        query, parameters = self._scan(table, start, stop, where)
+        return self.execute('select count(*) {0}'.format(query), parameters).fetchone()[0]
 
     def sent(self, visitor, verbose=True):
         '''
@@ -43,12 +733,9 @@ class EmailDatabase(sqlite3.Connection):
         visitor
             A callable that receives each email text.
         '''
-        cursor = self.cursor()
-        cursor.execute('select count(*) from sent_email')
-        count = cursor.fetchall()[0][0]
-        cursor.execute('select body from sent_email')
-        for row in tqdm(cursor.fetchall(), total=count, desc="Sent", unit='email', disable=(not verbose)):
-            visitor(row[0])
+        count = self.count('sent_email')
+        for body, in tqdm(self.emails('sent_email'), total=count, desc="Sent", unit='email', disable=(not verbose)):
+            visitor(body)
 
     def all(self, visitor, verbose=True):
         '''
@@ -59,9 +746,24 @@ class EmailDatabase(sqlite3.Connection):
         visitor
             A callable that receives each email text.
         '''
+        count = self.count('all_email')
+        for body, in tqdm(self.emails('all_email'), total=count, desc="All", unit='email', disable=(not verbose)):
+            visitor(body)
+
+    def headers(self, source, visitor, verbose=True):
+        '''
+        Visit all header only emails downloaded for a table.
+
+        Parameters
+        ----------
+        source
+            The email table name the headers were downloaded for, say 'sent_email'.
+        visitor
+            A callable that receives the text of each email's headers.
+        '''
         cursor = self.cursor()
-        cursor.execute('select count(*) from all_email')
+        cursor.execute('select count(*) from email_headers where source = ?', (source,))
         count = cursor.fetchall()[0][0]
-        cursor.execute('select body from all_email')
-        for row in tqdm(cursor, total=count, desc="All", unit='email', disable=(not verbose)):
-            visitor(row[0])
\ No newline at end of file
+        cursor.execute('select headers from email_headers where source = ?', (source,))
+        for row in tqdm(cursor, total=count, desc="Headers", unit='email', disable=(not verbose)):
+            visitor(row[0])
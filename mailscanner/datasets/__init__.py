@@ -3,4 +3,5 @@ Create machine learning datasets from email.
 '''
 
 from .replies import RepliedToDataset
-from .textfiles import LabeledTextFileDataset, StringsDataset
\ No newline at end of file
+from .textfiles import InferenceCodec, LabeledTextFileDataset, StringsDataset
+from .sequences import ArraySequence, ShardedTextFileDataset, TextFileSequence
\ No newline at end of file
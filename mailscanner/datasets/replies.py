@@ -2,7 +2,24 @@
 Create a dataset to learn which emails you are likely to reply to.
 '''
 
-from ..parser import parse
+import collections
+import glob
+import json
+import multiprocessing
+import os
+import re
+
+from ..databases import EmailDatabase
+from ..parser import parse_email
+
+# selected emails are read back, and parsed in parallel, this many at a time
+BATCH_SIZE = 512
+
+# not allowed in the text of a sample line
+SCRUB = re.compile('[\t\r\n]')
+
+# each worker process opens the database once
+_DATABASE = None
 
 
 class RepliedToDataset:
@@ -10,47 +27,295 @@ class RepliedToDataset:
     Build a dataset of emails that generated replies, along with a balanced number of
     negative samples that did not generate a reply.
 
-    This visits every sent email in the provided database, extracts identifiers of emails that 
-    generated replies, and hashes them.
+    Emails that generated replies are found with a query over the header index of the
+    provided database, matching the `In-Reply-To` of sent email, including sent email
+    downloaded as headers only, to the `Message-ID` of received email.
+
+    Received emails are then visited in order, taking each reply generating message. The
+    very next non-reply-generating message encountered is used as a negative sample to
+    offset and generate balanced classes. Only the emails taken are read and parsed.
+
+    Parsing is the slow part, so it can be spread across processes. The emails taken
+    are split into shards of consecutive rows, each worker reads and parses whole
+    shards, and the results are put back together in shard order, so the dataset
+    is the same no matter how many processes are used.
+
+    Samples can be streamed, see `samples` and `write`, rather than held in `dataset`,
+    so memory use does not grow with the mailbox.
 
-    With a hash of all emails that generated replies in hand, all received emails are visited
-    in order to extract the text of the email for each reply generating message. The very next
-    non-reply-generating message encountered is used as a negative sample to offset and generate
-    balanced classes.
+    A written dataset can be refreshed with only the email stored since, by passing
+    the `state` saved along with it. Emails already visited are not visited again,
+    so an email that gets a reply after it was visited keeps its original label.
+
+    >>> import os, tempfile
+    >>> from mailscanner.databases import EmailDatabase
+    >>> database = EmailDatabase(':memory:')
+    >>> def store(table, number, headers=''):
+    ...     database.save_identifiers(table, [str(number)])
+    ...     database.save_bodies(table, [(str(number), 'Message-ID: <{0}@example.com>\\r\\n{1}\\r\\nHello {0}'.format(
+    ...         number, headers).encode('utf8'))])
+    >>> for number in range(1, 5):
+    ...     store('all_email', number)
+    >>> store('sent_email', 10, 'In-Reply-To: <2@example.com>\\r\\n')
+    >>> folder = tempfile.mkdtemp()
+    >>> path = os.path.join(folder, 'replies.txt')
+    >>> RepliedToDataset(database, stream=True).write(path) == [path]
+    True
+    >>> open(path).read().splitlines()
+    ['Replied\\t<2@example.com> Hello 2 ', 'DidNotReply\\t<3@example.com> Hello 3 ']
+    >>> RepliedToDataset.load_state(path)
+    {'rowid': 5, 'taken': 2, 'replied': 1, 'written': 70}
+
+    More email arrives, and a refresh fails part way through writing.
+
+    >>> for number in range(5, 8):
+    ...     store('all_email', number)
+    >>> store('sent_email', 11, 'In-Reply-To: <6@example.com>\\r\\n')
+    >>> def interrupt():
+    ...     yield 'Replied', 'half written ' * 1024
+    ...     raise OSError('No space left on device')
+    >>> interrupted = RepliedToDataset(database, stream=True, state=RepliedToDataset.load_state(path))
+    >>> interrupted.samples = interrupt
+    >>> interrupted.write(path, append=True)
+    Traceback (most recent call last):
+    ...
+    OSError: No space left on device
+    >>> os.path.getsize(path) > RepliedToDataset.load_state(path)['written']
+    True
+
+    Refreshing again rolls that back, and ends up the same as building from scratch.
+
+    >>> refreshed = RepliedToDataset(database, stream=True, state=RepliedToDataset.load_state(path))
+    >>> refreshed.write(path, append=True) == [path]
+    True
+    >>> open(path).read().splitlines()[2:]
+    ['Replied\\t<6@example.com> Hello 6 ', 'DidNotReply\\t<7@example.com> Hello 7 ']
+    >>> rebuilt = os.path.join(folder, 'rebuilt.txt')
+    >>> RepliedToDataset(database).write(rebuilt) == [rebuilt]
+    True
+    >>> open(rebuilt).read() == open(path).read()
+    True
+    >>> RepliedToDataset.load_state(rebuilt) == RepliedToDataset.load_state(path)
+    True
 
     Attributes
     ----------
     dataset
-        A list of (Replied|DidNotReply, email text) tuples.
+        A list of (Replied|DidNotReply, email text) tuples, or None when streaming.
+    state
+        A dict of where to pick up from, `rowid` is the next email to visit, along
+        with the counts of samples `taken` and of those, `replied`. Up to date
+        once all samples are visited.
     '''
 
-    def __init__(self, email_database):
+    def __init__(self, email_database, jobs=1, stream=False, state=None):
         '''
         Parameters
         ----------
         email_database
             Visit this database to create training samples.
+        jobs
+            Parse in this many processes. An in memory database is always parsed
+            in this process, as other processes cannot open it.
+        stream
+            Do not build `dataset` now, samples are generated as visited by `samples`.
+        state
+            The `state` of a previous build, only emails stored since are visited.
         '''
-        replied_to = {}
+        self.email_database = email_database
+        self.jobs = jobs
+        self.state = dict(state or {'rowid': 1, 'taken': 0, 'replied': 0})
+        self.dataset = None
+        if not stream:
+            self.dataset = list(self.samples())
 
-        def is_a_reply(email):
-            reply = parse(email).get('In-Reply-To', None)
-            if reply:
-                replied_to[reply] = True
+    def selected(self):
+        '''
+        Choose the emails to sample, in shards.
 
-        email_database.sent(is_a_reply)
+        Returns
+        -------
+        generator
+            Yields lists of up to `BATCH_SIZE` (rowid, Replied|DidNotReply) tuples.
+        '''
+        state = self.state
+        # stop short of any email still to be downloaded, so a refresh visits it later
+        stop, last = self.email_database.execute('''
+            select
+                (select min(rowid) from all_email where rowid >= ? and body is null and body_key is null),
+                (select max(rowid) from all_email)
+        ''', (state['rowid'],)).fetchone()
+        shard = []
+        emails = self.email_database.emails('all_email', columns=('rowid', 'replied'), start=state['rowid'], stop=stop)
+        for rowid, replied in emails:
+            if replied:
+                # a message that generated a reply!
+                shard.append((rowid, 'Replied'))
+                state['replied'] += 1
+            elif state['taken'] % 2 == 1:
+                # if we get here, this was not a reply, use it as a negative sample
+                # if we have an odd number of entries to balance out
+                shard.append((rowid, 'DidNotReply'))
+            else:
+                continue
+            state['taken'] += 1
+            if len(shard) == BATCH_SIZE:
+                yield shard
+                shard = []
+        if shard:
+            yield shard
+        state['rowid'] = max(state['rowid'], stop or (last or 0) + 1)
+
+    def samples(self):
+        '''
+        Read and parse the selected emails.
 
-        self.dataset = []
+        Returns
+        -------
+        generator
+            Yields (Replied|DidNotReply, email text) tuples, in the order emails were stored.
+        '''
+        if self.dataset is not None:
+            yield from self.dataset
+            return
+        email_database = self.email_database
+        email_database.index_headers()
+        if self.jobs > 1 and email_database.filename != ':memory:':
+            with multiprocessing.Pool(self.jobs, initializer=_open, initargs=(email_database.filename,)) as pool:
+                # a few shards in flight per worker, taken back in order
+                pending = collections.deque()
+                for shard in self.selected():
+                    pending.append(pool.apply_async(_samples, (shard,)))
+                    if len(pending) > self.jobs * 2:
+                        yield from pending.popleft().get()
+                while pending:
+                    yield from pending.popleft().get()
+        else:
+            for shard in self.selected():
+                yield from _samples(shard, email_database)
 
-        def extract_replies(email):
-            email = parse(email)
-            if replied_to.get(email.get('Message-ID'), False):
-                # a message that generated a reply!
-                self.dataset.append(('Replied', ' '.join(map(str, email.values()))))
-                return
-            # if we get here, this was not a reply, use it as a negative sample
-            # if we have an odd number of entries to balance out
-            if len(self.dataset) % 2 == 1:
-                self.dataset.append(('DidNotReply', ' '.join(map(str, email.values()))))
-
-        email_database.all(extract_replies)
+    def write(self, path, shard_size=None, append=False):
+        '''
+        Write samples out as text, one per line:
+        <label> <tab> <text>
+
+        Tabs and line breaks in the text become spaces. The `state` is saved
+        alongside once every sample is written, see `load_state`, along with how
+        much was written. Unless appending, text files already in a `shard_size`
+        folder are removed first, so no stale shards are left behind. The file or
+        folder is created even when there are no samples.
+
+        When appending, anything past what the saved state accounts for, left by a
+        write that was interrupted, is removed first, as those emails are visited
+        again, so they are not written twice.
+
+        Parameters
+        ----------
+        path
+            A text file, or with `shard_size`, a folder to fill with numbered text files.
+        shard_size
+            Start a new file after this many samples.
+        append
+            Add to the samples already written, say when refreshing, rather than replacing them.
+            New shards are started after the existing ones.
+
+        Returns
+        -------
+        list
+            The paths written.
+        '''
+        paths = []
+        output = None
+        shards = 0
+        # bytes of a text file, or shards in a folder, the saved state accounts for
+        written = (self.load_state(path) or {}).get('written') if append else 0
+        if not append and os.path.exists(state_path(path)):
+            # until this write is done, there is nothing to refresh from
+            os.remove(state_path(path))
+        if shard_size:
+            os.makedirs(path, exist_ok=True)
+            existing = shard_files(path)
+            if written is None:
+                written = len(existing)
+            for name in existing[written:]:
+                os.remove(name)
+            shards = min(written, len(existing))
+        else:
+            paths.append(path)
+            output = open(path, 'a' if append else 'w')
+            if written is not None:
+                output.truncate(written)
+        for number, (label, text) in enumerate(self.samples()):
+            if shard_size and number % shard_size == 0:
+                if output:
+                    output.close()
+                paths.append(os.path.join(path, '{0:05d}.txt'.format(shards + len(paths))))
+                output = open(paths[-1], 'w')
+            output.write('{0}\t{1}\n'.format(label, SCRUB.sub(' ', text)))
+        if output:
+            output.close()
+        written = shards + len(paths) if shard_size else os.path.getsize(path)
+        # replaced whole, so an interrupted write leaves the last state in place
+        with open(state_path(path) + '.partial', 'w') as state_file:
+            json.dump(dict(self.state, written=written), state_file)
+        os.replace(state_path(path) + '.partial', state_path(path))
+        return paths
+
+    @staticmethod
+    def load_state(path):
+        '''
+        Load the state saved by `write` to the same path.
+
+        Returns
+        -------
+        dict
+            The saved state, or None if nothing has been written.
+        '''
+        if not os.path.exists(state_path(path)):
+            return None
+        with open(state_path(path)) as state_file:
+            return json.load(state_file)
+
+
+def shard_files(path):
+    '''
+    The text files in a folder of shards, in name order.
+    '''
+    return sorted(glob.glob(os.path.join(path, '*.txt')))
+
+
+def state_path(path):
+    '''
+    Where the state of a dataset written to `path` is saved, next to it.
+    '''
+    return path.rstrip(os.sep) + '.state.json'
+
+
+def _open(database_filename):
+    '''
+    Open the database in a worker process.
+    '''
+    global _DATABASE
+    _DATABASE = EmailDatabase(database_filename)
+
+
+def _samples(shard, email_database=None):
+    '''
+    Read and parse a shard of selected emails.
+
+    Parameters
+    ----------
+    shard
+        A list of (rowid, label) tuples, in rowid order.
+    email_database
+        Read from this database, defaults to the one opened for this worker process.
+
+    Returns
+    -------
+    list
+        A list of (label, email text) tuples.
+    '''
+    email_database = email_database or _DATABASE
+    where = ('all_email.rowid in ({0})'.format(','.join('?' * len(shard))),) + tuple(rowid for rowid, _ in shard)
+    emails = email_database.emails('all_email', columns=('body',), where=where)
+    return [(label, parse_email(body).to_text()) for (_, label), (body,) in zip(shard, emails)]
@@ -0,0 +1,213 @@
+'''
+Stream text files on disk to keras a batch at a time, for datasets larger than memory.
+'''
+
+import glob
+import os
+
+import keras
+import numpy as np
+from sklearn.preprocessing import LabelEncoder
+from vectoria import CharacterTrigramEmbedding
+
+from .textfiles import InferenceCodec
+from .trigrams import CHUNK_SIZE, bucketed, lengths, sequence, trim
+
+# with just one file, hold out this much of it for validation
+VALIDATION_SPLIT = 0.01
+
+
+class ShardedTextFileDataset:
+    '''
+    Read text files with one string per line, of the form:
+    <label> <tab> <text>
+
+    Unlike `LabeledTextFileDataset`, texts are not read into memory. Files are
+    scanned once, remembering where each line starts, its length and its label, and
+    lines are read back and sequenced a batch at a time as a model trains. Lines of
+    about the same length are batched together.
+
+    Given a folder of files, say from `RepliedToDataset.write` with a `shard_size`,
+    the last files are held out for validation.
+
+    >>> import mailscanner
+    >>> dataset = mailscanner.datasets.ShardedTextFileDataset('./var/data/labeled.txt', batch_size=1)
+    >>> len(dataset.training), dataset.validation
+    (2, None)
+    >>> texts, labels = dataset.training[0]
+    >>> labels.shape
+    (1, 2)
+
+    Attributes
+    ----------
+    training
+        A `TextFileSequence` of batches to train on.
+    validation
+        A `TextFileSequence` of held out batches, or None if there are too few samples.
+    trigram
+        A `CharacterTrigramEmbedding` instance, where you can get the embedding model.
+    label_encoder
+        Turns labels into classes and back.
+    '''
+
+    def __init__(self, path, batch_size=128, validation_shards=1):
+        '''
+        Parameters
+        ----------
+        path
+            A text file, or a folder of .txt files.
+        batch_size
+            Samples in each batch.
+        validation_shards
+            Hold out this many files, the last ones in name order, for validation.
+        '''
+        if os.path.isdir(path):
+            paths = sorted(glob.glob(os.path.join(path, '*.txt')))
+        else:
+            paths = [path]
+        self.trigram = CharacterTrigramEmbedding()
+        self.label_encoder = LabelEncoder()
+        shards = [scan(shard) for shard in paths]
+        self.label_encoder.fit([label for _, _, labels in shards for label in labels])
+
+        def sequence(paths, shards):
+            if not sum(len(offsets) for offsets, _, _ in shards):
+                return None
+            return TextFileSequence(paths, shards, self.codec(), batch_size=batch_size)
+
+        if len(paths) > validation_shards:
+            split = len(paths) - validation_shards
+            self.training = sequence(paths[:split], shards[:split])
+            self.validation = sequence(paths[split:], shards[split:])
+        else:
+            # not enough files, hold out the tail of the last one
+            offsets, sizes, labels = shards[-1]
+            split = len(offsets) - int(len(offsets) * VALIDATION_SPLIT)
+            self.training = sequence(paths, shards[:-1] + [(offsets[:split], sizes[:split], labels[:split])])
+            self.validation = sequence(paths[-1:], [(offsets[split:], sizes[split:], labels[split:])])
+
+    def codec(self):
+        '''
+        Just what is needed to encode text and decode predictions, without the data.
+
+        Returns
+        -------
+        InferenceCodec
+        '''
+        return InferenceCodec(self.trigram, self.label_encoder)
+
+
+class ArraySequence(keras.utils.Sequence):
+    '''
+    Batches of already sequenced texts and one hot labels, grouping texts of about
+    the same length, and trimmed of padding, see `trigrams.bucketed`, in a shuffled
+    order that changes each epoch.
+    '''
+
+    def __init__(self, texts, labels, batch_size=128, shuffle=True):
+        '''
+        Parameters
+        ----------
+        texts
+            A 2-d tensor of ngram sequences, say `LabeledTextFileDataset.texts`.
+        labels
+            One hot labels, say `LabeledTextFileDataset.one_hot_labels`.
+        batch_size
+            Samples in each batch, at most.
+        shuffle
+            Visit samples in a different random order each epoch.
+        '''
+        self.texts = texts
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        # a chunk at a time, texts may well be memory mapped
+        self.lengths = np.concatenate([lengths(texts[start:start + CHUNK_SIZE]) for start in range(0, len(texts), CHUNK_SIZE)] or [[]])
+        self.on_epoch_end()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        batch = np.sort(self.batches[index])
+        return trim(self.texts[batch]), self.labels[batch]
+
+    def on_epoch_end(self):
+        self.batches = bucketed(self.lengths, self.batch_size, self.texts.shape[1], shuffle=self.shuffle)
+
+
+class TextFileSequence(keras.utils.Sequence):
+    '''
+    Batches of sequenced texts and one hot labels, read from text files as needed,
+    grouping lines of about the same length, in a shuffled order that changes each
+    epoch. This only holds line offsets, lengths and labels, so it is cheap to send
+    to multiprocessing workers.
+    '''
+
+    def __init__(self, paths, shards, codec, batch_size=128, shuffle=True):
+        '''
+        Parameters
+        ----------
+        paths
+            Text files to read.
+        shards
+            For each path, arrays of line offsets, line lengths and labels, see `scan`.
+        codec
+            An `InferenceCodec` to sequence texts and encode labels.
+        batch_size
+            Samples in each batch.
+        shuffle
+            Visit samples in a different random order each epoch.
+        '''
+        self.paths = paths
+        self.codec = codec
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.files = np.concatenate([np.full(len(offsets), number, dtype=np.int32) for number, (offsets, _, _) in enumerate(shards)])
+        self.offsets = np.concatenate([offsets for offsets, _, _ in shards])
+        self.sizes = np.concatenate([sizes for _, sizes, _ in shards])
+        self.labels = codec.label_encoder.transform(np.concatenate([labels for _, _, labels in shards]))
+        self.on_epoch_end()
+
+    def __len__(self):
+        return len(self.batches)
+
+    def __getitem__(self, index):
+        batch = self.batches[index]
+        texts = {}
+        # read file by file, in file order, to keep seeks short
+        for number in np.unique(self.files[batch]):
+            with open(self.paths[number], 'rb') as text_file:
+                for sample in sorted(batch[self.files[batch] == number], key=lambda sample: self.offsets[sample]):
+                    text_file.seek(self.offsets[sample])
+                    texts[sample] = text_file.readline().decode('utf8').split('\t', 1)[1].strip()
+        sequenced = sequence(self.codec.trigram, [texts[sample] for sample in batch])
+        one_hot = np.eye(len(self.codec.label_encoder.classes_))[self.labels[batch]]
+        return trim(sequenced), one_hot
+
+    def on_epoch_end(self):
+        # line length in bytes is close enough to the number of trigrams to bucket
+        self.batches = bucketed(self.sizes, self.batch_size, self.codec.trigram.maxlen, shuffle=self.shuffle)
+
+
+def scan(path):
+    '''
+    Find where each line of a text file starts, its length, and its label.
+
+    Returns
+    -------
+    tuple
+        An array of byte offsets, an array of byte lengths, and an array of label strings.
+    '''
+    offsets = []
+    sizes = []
+    labels = []
+    offset = 0
+    with open(path, 'rb') as text_file:
+        for line in text_file:
+            if line.strip():
+                offsets.append(offset)
+                sizes.append(len(line))
+                labels.append(line.split(b'\t', 1)[0].decode('utf8'))
+            offset += len(line)
+    return np.array(offsets, dtype=np.int64), np.array(sizes, dtype=np.int64), np.array(labels, dtype=object)
@@ -2,7 +2,12 @@
 Turn text files on disk into in memory tensors for use with machine learning.
 '''
 
+import copy
+import json
+import os
 import pickle
+import shutil
+
 import numpy as np
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import LabelBinarizer, LabelEncoder, OneHotEncoder
@@ -10,6 +15,18 @@ from smart_open import smart_open
 
 from vectoria import CharacterTrigramEmbedding
 
+from .trigrams import SequenceCache, sequence
+
+# saved dataset directory layout, arrays are .npy so they load memory mapped
+MANIFEST = 'manifest.json'
+ENCODERS = 'encoders.pickle'
+ARRAYS = ['texts', 'labels', 'one_hot_labels']
+# the trigram embedding matrix is saved on its own, rather than pickled with the encoders
+EMBEDDINGS = 'embeddings.npy'
+FORMAT = 2
+# suffix of the directory written in place of an existing file, before it is replaced
+SAVING = '.saving'
+
 
 class LabeledTextFileDataset:
     '''
@@ -38,11 +55,27 @@ class LabeledTextFileDataset:
            [107523,  82916, 185037, ...,      0,      0,      0]], dtype=int32)
     >>> dataset.decode_prediction([0.25, 0.75])
     ('Good', 0.75)
-    >>> dataset.save('/tmp/labeled.pickle')
-    >>> readback = mailscanner.datasets.LabeledTextFileDataset.load('/tmp/labeled.pickle')
+    >>> dataset.save('/tmp/labeled')
+    >>> readback = mailscanner.datasets.LabeledTextFileDataset.load('/tmp/labeled')
+    >>> readback.texts.shape == dataset.texts.shape
+    True
+    >>> readback.trigram.embeddings.shape == dataset.trigram.embeddings.shape
+    True
+
+    A pickle file saved by older versions at the same path is replaced.
+
+    >>> import os, tempfile
+    >>> path = os.path.join(tempfile.mkdtemp(), 'labeled.pickle')
+    >>> with open(path, 'wb') as older:
+    ...     _ = older.write(b'pickled')
+    >>> dataset.save(path)
+    >>> os.path.isdir(path), os.listdir(os.path.dirname(path))
+    (True, ['labeled.pickle'])
+    >>> mailscanner.datasets.LabeledTextFileDataset.load(path).labels.tolist()
+    [1, 0]
     '''
 
-    def __init__(self, textfile_path):
+    def __init__(self, textfile_path, jobs=1, cache=None):
         '''
         Read the text, and separate it.
 
@@ -51,6 +84,10 @@ class LabeledTextFileDataset:
         textfile_path
             A string path, which is passed to `smart_open`, so this can can a local file
             or even an S3 url.
+        jobs
+            Sequence text in this many processes.
+        cache
+            A path to a SQLite file of sequenced text, see `SequenceCache`.
         '''
         label_buffer = []
         text_buffer = []
@@ -65,10 +102,148 @@ class LabeledTextFileDataset:
         self.labels = label_encoder.fit_transform(label_buffer)
         self.one_hot_labels = OneHotEncoder().fit_transform(LabelBinarizer().fit_transform(self.labels)).toarray()
         # mildly tricky, need to wrap the array in an array
-        strings = StringsDataset(text_buffer)
+        strings = StringsDataset(text_buffer, jobs=jobs, cache=cache)
         self.trigram = strings.trigram
         self.texts = strings.texts
 
+    def decode_prediction(self, one_hot):
+        '''
+        Given a set of one-hot encoded values, return the labels and prediction values.
+        '''
+        return self.codec().decode_prediction(one_hot)
+
+    def codec(self):
+        '''
+        Just what is needed to encode text and decode predictions, without the data.
+
+        Returns
+        -------
+        InferenceCodec
+        '''
+        return InferenceCodec(self.trigram, self.label_encoder)
+
+    def save(self, path_to_directory):
+        '''
+        Save this dataset off to a directory, with each array in its own `.npy`
+        file, including the trigram embedding matrix, the fitted encoders pickled,
+        and a small json manifest.
+
+        Parameters
+        ----------
+        path_to_directory
+            A string path, the directory is created if needed. A file already there,
+            such as a pickle saved by older versions, is replaced once the directory
+            is written.
+        '''
+        final_directory = path_to_directory
+        if os.path.isfile(final_directory):
+            # written beside the file, and moved over it only when complete
+            path_to_directory = final_directory + SAVING
+            shutil.rmtree(path_to_directory, ignore_errors=True)
+        os.makedirs(path_to_directory, exist_ok=True)
+        for name in ARRAYS:
+            np.save(os.path.join(path_to_directory, name + '.npy'), getattr(self, name))
+        np.save(os.path.join(path_to_directory, EMBEDDINGS), self.trigram.embeddings)
+        trigram = copy.copy(self.trigram)
+        del trigram.embeddings
+        encoders = {
+            'label_encoder': self.label_encoder,
+            'label_binarizer': self.label_binarizer,
+            'onehot_encoder': self.onehot_encoder,
+            'trigram': trigram,
+        }
+        with open(os.path.join(path_to_directory, ENCODERS), 'wb') as encoders_file:
+            pickle.dump(encoders, encoders_file)
+        manifest = {
+            'format': FORMAT,
+            'samples': len(self.labels),
+            'maxlen': self.trigram.maxlen,
+            'classes': [str(label) for label in self.label_encoder.classes_],
+            'arrays': {name: {'shape': getattr(self, name).shape, 'dtype': str(getattr(self, name).dtype)} for name in ARRAYS},
+            'encoders': ENCODERS,
+            'embeddings': EMBEDDINGS,
+        }
+        with open(os.path.join(path_to_directory, MANIFEST), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+        if path_to_directory != final_directory:
+            os.remove(final_directory)
+            os.rename(path_to_directory, final_directory)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        '''
+        Load up a saved dataset. Arrays, and the trigram embedding matrix, are memory
+        mapped read only, so loading is quick, and processes loading the same dataset
+        share its memory.
+
+        Parameters
+        ----------
+        path
+            A directory written by `save`, or a pickle file from older versions.
+        mmap_mode
+            Passed to `np.load`, None reads arrays fully into memory.
+        '''
+        if not os.path.isdir(path):
+            return pickle.load(open(path, 'rb'))
+        with open(os.path.join(path, MANIFEST)) as manifest_file:
+            manifest = json.load(manifest_file)
+        if manifest['format'] > FORMAT:
+            raise ValueError('dataset format {0} is newer than this version reads'.format(manifest['format']))
+        dataset = cls.__new__(cls)
+        with open(os.path.join(path, manifest['encoders']), 'rb') as encoders_file:
+            dataset.__dict__.update(pickle.load(encoders_file))
+        for name in manifest['arrays']:
+            setattr(dataset, name, np.load(os.path.join(path, name + '.npy'), mmap_mode=mmap_mode))
+        if 'embeddings' in manifest:
+            dataset.trigram.embeddings = np.load(os.path.join(path, manifest['embeddings']), mmap_mode=mmap_mode)
+        return dataset
+
+
+class InferenceCodec:
+    '''
+    The encoders of a `LabeledTextFileDataset`, without any of the data, which is all
+    a model needs to be built and serve predictions.
+
+    >>> import mailscanner
+    >>> dataset = mailscanner.datasets.LabeledTextFileDataset('./var/data/labeled.txt')
+    >>> dataset.codec().save('/tmp/labeled.codec')
+    >>> codec = mailscanner.datasets.InferenceCodec.load('/tmp/labeled.codec')
+    >>> codec.decode_prediction([0.25, 0.75])
+    ('Good', 0.75)
+
+    The pretrained embedding matrix is not saved, it is large, and the weights of a
+    trained model carry it anyway, just its shape is kept to build the model.
+
+    Attributes
+    ----------
+    trigram
+        A `CharacterTrigramEmbedding` instance, with the `sequencer` to encode text.
+    label_encoder
+        Turns predicted classes back into labels.
+    embedding_shape
+        The shape of the trigram embedding matrix.
+    '''
+
+    def __init__(self, trigram, label_encoder):
+        '''
+        Parameters
+        ----------
+        trigram
+            A `CharacterTrigramEmbedding` instance.
+        label_encoder
+            A fitted `LabelEncoder`.
+        '''
+        self.trigram = trigram
+        self.label_encoder = label_encoder
+        self.embedding_shape = trigram.embeddings.shape
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        if getattr(self.trigram, 'embeddings', None) is not None:
+            state['trigram'] = copy.copy(self.trigram)
+            del state['trigram'].embeddings
+        return state
+
     def decode_prediction(self, one_hot):
         '''
         Given a set of one-hot encoded values, return the labels and prediction values.
@@ -79,16 +254,30 @@ class LabeledTextFileDataset:
 
     def save(self, path_to_file):
         '''
-        Save this dataset off to a pickle.
+        Save this codec off to a pickle.
         '''
-        pickle.dump(self, open(path_to_file, 'wb'))
+        with open(path_to_file, 'wb') as codec_file:
+            pickle.dump(self, codec_file)
 
     @classmethod
-    def load(cls, path_to_file):
+    def load(cls, path):
         '''
-        Load up a pickled dataset.
+        Load up a saved codec.
+
+        Parameters
+        ----------
+        path
+            A file written by `save`, or a whole saved `LabeledTextFileDataset`, in
+            which case just the codec is kept.
         '''
-        return pickle.load(open(path_to_file, 'rb'))
+        if not os.path.isdir(path):
+            with open(path, 'rb') as codec_file:
+                codec = pickle.load(codec_file)
+        else:
+            codec = LabeledTextFileDataset.load(path)
+        if isinstance(codec, LabeledTextFileDataset):
+            codec = codec.codec()
+        return codec
 
 
 class StringsDataset:
@@ -103,12 +292,17 @@ class StringsDataset:
         A `CharacterTrigramEmbedding` instance, where you can get the embedding model.
     '''
 
-    def __init__(self, strings):
+    def __init__(self, strings, jobs=1, cache=None):
         '''
         Parameters
         ----------
         strings
             A list of strings to transform.
+        jobs
+            Sequence in this many processes.
+        cache
+            A path to a SQLite file of sequenced strings, see `SequenceCache`.
         '''
         self.trigram = CharacterTrigramEmbedding()
-        self.texts = self.trigram.sequencer.transform(strings)
+        cache = cache and SequenceCache(cache, self.trigram)
+        self.texts = sequence(self.trigram, strings, jobs=jobs, cache=cache)
@@ -0,0 +1,300 @@
+'''
+Turn strings into trigram sequences, in parallel, reading only as much of each
+string as fits, and optionally cached on disk.
+'''
+
+import functools
+import hashlib
+import multiprocessing
+import pickle
+import re
+import sqlite3
+import weakref
+
+import numpy as np
+
+# strings are handed to worker processes this many at a time
+CHUNK_SIZE = 1024
+
+# shortest sequence a model is given, the convolutions and pooling need this many steps
+MIN_LENGTH = 32
+
+# each worker process gets the embedding once
+_TRIGRAM = None
+
+# whether `truncates` found each embedding safe to truncate
+_TRUNCATES = weakref.WeakKeyDictionary()
+
+# strings are only cut at the start of whitespace no html entity spans
+BOUNDARY = re.compile(r'(?<=\S)[ \t\n\f]')
+
+# repeated past `maxlen` to check truncation, with case, entities and runs of whitespace to clean up
+PROBE = 'Subject: Fish &amp; Chips\r\n\r\nHello  World,\t&lt;b&gt;Bold&lt;/b&gt;&nbsp;and\n\n  MORE  text; '
+
+
+def sequence(trigram, strings, jobs=1, cache=None):
+    '''
+    Sequence strings into a 2-d tensor of ngram identifiers, the same as
+    `trigram.sequencer.transform`, but faster.
+
+    Parameters
+    ----------
+    trigram
+        A `CharacterTrigramEmbedding` instance.
+    strings
+        A list of strings to transform.
+    jobs
+        Sequence in this many processes.
+    cache
+        A `SequenceCache`, strings already in it are not sequenced again.
+
+    Returns
+    -------
+    numpy.ndarray
+        One row of `trigram.maxlen` identifiers per string.
+    '''
+    rows = cache.get(strings) if cache else [None] * len(strings)
+    todo = [number for number, row in enumerate(rows) if row is None]
+    chunks = [[strings[number] for number in todo[start:start + CHUNK_SIZE]] for start in range(0, len(todo), CHUNK_SIZE)]
+    exact = truncates(trigram)
+    if jobs > 1 and len(chunks) > 1:
+        with multiprocessing.Pool(jobs, initializer=_open, initargs=(trigram,)) as pool:
+            sequenced = pool.imap(functools.partial(_sequence, exact=exact), chunks)
+            sequenced = [row for chunk in sequenced for row in chunk]
+    else:
+        sequenced = [row for chunk in chunks for row in _sequence(chunk, trigram, exact)]
+    for number, row in zip(todo, sequenced):
+        rows[number] = row
+    if cache:
+        cache.put([strings[number] for number in todo], sequenced)
+    if not rows:
+        return trigram.sequencer.transform([])
+    return np.stack(rows)
+
+
+def truncated(trigram, strings):
+    '''
+    Sequence strings, reading only a prefix of each that fills a row, rather than
+    the whole string. Prefixes start at `maxlen` characters, and grow for any string
+    that did not fill its row. Each is cut just before whitespace, see `prefix`.
+
+    This assumes the sequencer keeps the start of a string, see `truncates`.
+
+    Parameters
+    ----------
+    trigram
+        A `CharacterTrigramEmbedding` instance.
+    strings
+        A list of strings to transform.
+
+    Returns
+    -------
+    numpy.ndarray
+        One row of `trigram.maxlen` identifiers per string.
+    '''
+    length = np.full(len(strings), trigram.maxlen + 2)
+    todo = list(range(len(strings)))
+    rows = None
+    while todo:
+        cuts = [prefix(strings[number], length[number]) for number in todo]
+        sequenced = trigram.sequencer.transform(cuts)
+        if rows is None:
+            rows = np.zeros((len(strings), sequenced.shape[1]), dtype=sequenced.dtype)
+        rows[todo] = sequenced
+        for number, cut in zip(todo, cuts):
+            length[number] = len(cut) * 2
+        # a row ending in padding was not filled, try again with more if there is more
+        todo = [number for number, cut, row in zip(todo, cuts, sequenced) if row[-1] == 0 and len(cut) < len(strings[number])]
+    if rows is None:
+        return trigram.sequencer.transform([])
+    return rows
+
+
+def prefix(string, length):
+    '''
+    The start of a string, at least `length` characters, cut just before a run of
+    whitespace. An html entity never spans whitespace, and a whole run of whitespace
+    is left out, so the prefix cleans up to the start of what the whole string
+    cleans up to, and sequences to the start of its row.
+
+    >>> prefix('fish &amp; chips', 7)
+    'fish &amp;'
+    >>> prefix('fish   and chips', 5)
+    'fish   and'
+    >>> prefix('fish&amp;chips', 5)
+    'fish&amp;chips'
+    '''
+    if len(string) <= length:
+        return string
+    boundary = BOUNDARY.search(string, length)
+    return string[:boundary.start()] if boundary else string
+
+
+def truncates(trigram):
+    '''
+    Check that `truncated` gives the same result as sequencing the whole string,
+    which depends on how the sequencer pads, truncates and cleans up text, on
+    `PROBE` repeated to a few times `maxlen`. This is checked once for each
+    embedding, and remembered.
+
+    >>> from vectoria import CharacterTrigramEmbedding
+    >>> truncates(CharacterTrigramEmbedding())
+    True
+
+    Returns
+    -------
+    bool
+        True when `truncated` is safe to use.
+    '''
+    exact = _TRUNCATES.get(trigram)
+    if exact is None:
+        probe = PROBE * (4 * trigram.maxlen // len(PROBE) + 1)
+        exact = np.array_equal(truncated(trigram, [probe]), trigram.sequencer.transform([probe]))
+        _TRUNCATES[trigram] = exact
+    return exact
+
+
+def lengths(rows):
+    '''
+    The length of each row, up to and including its last identifier, so without
+    any trailing padding.
+
+    >>> lengths(np.array([[1, 2, 0, 0], [3, 0, 4, 0], [0, 0, 0, 0]]))
+    array([2, 3, 0])
+    '''
+    present = rows != 0
+    return np.where(present.any(axis=1), rows.shape[1] - np.argmax(present[:, ::-1], axis=1), 0)
+
+
+def bucket(length, maxlen):
+    '''
+    Round lengths up to a bucket, a power of two, at least `MIN_LENGTH` and at most
+    `maxlen`, so there are only a few different lengths for a model to see.
+
+    >>> bucket(np.array([1, 33, 1000]), 256)
+    array([ 32,  64, 256])
+    '''
+    length = np.maximum(length, MIN_LENGTH)
+    return np.minimum(maxlen, 2 ** np.ceil(np.log2(length)).astype(int))
+
+
+def trim(rows):
+    '''
+    Cut off the trailing padding that all rows share, down to a bucket length, so a
+    model does not spend time on padding.
+
+    >>> trim(np.zeros((2, 1024), dtype=np.int32)).shape
+    (2, 32)
+    '''
+    longest = lengths(rows).max() if len(rows) else 0
+    return rows[:, :bucket(longest, rows.shape[1])]
+
+
+def bucketed(length, batch_size, maxlen, shuffle=True):
+    '''
+    Group samples of about the same length into batches.
+
+    Parameters
+    ----------
+    length
+        An array with the length, or an estimate of it, of each sample.
+    batch_size
+        Samples in each batch, at most.
+    maxlen
+        The longest bucket.
+    shuffle
+        Shuffle samples within each bucket, and the order of the batches.
+
+    Returns
+    -------
+    list
+        Arrays of sample numbers, one for each batch.
+    '''
+    buckets = bucket(np.asarray(length), maxlen)
+    batches = []
+    for size in np.unique(buckets):
+        members = np.flatnonzero(buckets == size)
+        if shuffle:
+            np.random.shuffle(members)
+        batches.extend(members[start:start + batch_size] for start in range(0, len(members), batch_size))
+    if shuffle:
+        batches = [batches[number] for number in np.random.permutation(len(batches))]
+    return batches
+
+
+class SequenceCache:
+    '''
+    Sequenced rows in a SQLite file, keyed by a hash of the string, and of the
+    sequencer, so a different sequencer does not pick up stale rows.
+
+    >>> from vectoria import CharacterTrigramEmbedding
+    >>> trigram = CharacterTrigramEmbedding()
+    >>> cache = SequenceCache(':memory:', trigram)
+    >>> cache.get(['hello'])
+    [None]
+    >>> cache.put(['hello'], trigram.sequencer.transform(['hello']))
+    >>> cache.get(['hello'])[0].shape == (trigram.maxlen,)
+    True
+    '''
+
+    def __init__(self, path, trigram):
+        '''
+        Parameters
+        ----------
+        path
+            A string, where to store the file on disk.
+        trigram
+            The `CharacterTrigramEmbedding` that sequences the cached rows.
+        '''
+        self.database = sqlite3.connect(path)
+        self.database.execute('create table if not exists sequenced(key text primary key, dtype text, row blob)')
+        self.database.commit()
+        self.fingerprint = hashlib.sha1(pickle.dumps(trigram.sequencer)).digest()
+
+    def key(self, string):
+        return hashlib.sha1(self.fingerprint + string.encode('utf8')).hexdigest()
+
+    def get(self, strings):
+        '''
+        Returns
+        -------
+        list
+            A row for each string, or None when not cached.
+        '''
+        keys = [self.key(string) for string in strings]
+        found = {}
+        # in batches, under the SQLite parameter limit
+        for start in range(0, len(keys), 512):
+            batch = keys[start:start + 512]
+            query = 'select key, dtype, row from sequenced where key in ({0})'.format(','.join('?' * len(batch)))
+            for key, dtype, row in self.database.execute(query, batch):
+                found[key] = np.frombuffer(row, dtype=dtype)
+        return [found.get(key) for key in keys]
+
+    def put(self, strings, rows):
+        '''
+        Remember the rows sequenced from strings.
+        '''
+        self.database.executemany('''
+            insert or replace into sequenced (key, dtype, row)
+            values (?, ?, ?)
+        ''', ((self.key(string), str(row.dtype), row.tobytes()) for string, row in zip(strings, rows)))
+        self.database.commit()
+
+
+def _open(trigram):
+    '''
+    Keep the embedding in a worker process.
+    '''
+    global _TRIGRAM
+    _TRIGRAM = trigram
+
+
+def _sequence(strings, trigram=None, exact=True):
+    '''
+    Sequence a chunk of strings, truncated when `exact` says that is safe.
+    '''
+    trigram = trigram or _TRIGRAM
+    if exact:
+        return list(truncated(trigram, strings))
+    return list(trigram.sequencer.transform(strings))
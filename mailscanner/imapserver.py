@@ -0,0 +1,293 @@
+'''
+A small IMAP server holding email in memory, enough of IMAP4rev1 and CONDSTORE
+to test `sources` against, without a real mail server.
+'''
+
+import email.parser
+import email.policy
+import re
+import select
+import socketserver
+import threading
+
+# seconds held FETCH responses wait for more pipelined commands
+HOLD_WAIT = 0.05
+
+# like Gmail, ENABLE and CONDSTORE are only advertised once logged in
+CAPABILITIES = ('IMAP4rev1',)
+LOGIN_CAPABILITIES = ('IMAP4rev1', 'ENABLE', 'CONDSTORE')
+
+COMMAND = re.compile(r'^(\S+) (\S+) ?(.*)$')
+HEADER_FIELDS = re.compile(r'BODY\.PEEK\[HEADER\.FIELDS \(([^)]*)\)\]', re.IGNORECASE)
+
+
+class ImapServer(socketserver.ThreadingTCPServer):
+    '''
+    Serve folders of email on localhost, from a background thread. Any user name
+    and password logs in.
+
+    >>> server = ImapServer({'INBOX': [b'Subject: one\\r\\n\\r\\nHello']})
+    >>> server.append('INBOX', b'Subject: two\\r\\n\\r\\nHello')
+    2
+    >>> import imaplib
+    >>> mail = imaplib.IMAP4('127.0.0.1', server.port)
+    >>> mail.login('user', 'password')[0]
+    'OK'
+    >>> mail.select('INBOX')
+    ('OK', [b'2'])
+    >>> mail.uid('fetch', '2', '(RFC822)')[1][0]
+    (b'2 (UID 2 RFC822 {21}', b'Subject: two\\r\\n\\r\\nHello')
+    >>> mail.logout()[0]
+    'BYE'
+    >>> server.commands
+    ['LOGIN user "password"', 'SELECT INBOX', 'UID FETCH 2 (RFC822)', 'LOGOUT']
+    >>> server.close()
+
+    Attributes
+    ----------
+    port
+        The port to connect to, picked by the operating system.
+    folders
+        A dict of folder name to a dict of UID to RFC822 bytes.
+    uidvalidity
+        A dict of folder name to its UIDVALIDITY.
+    modseq
+        A dict of folder name to its HIGHESTMODSEQ, it goes up with each change.
+    commands
+        Every command received after the capability check, less its tag, in order.
+    '''
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, folders=None, capabilities=CAPABILITIES, login_capabilities=LOGIN_CAPABILITIES, interleave=1):
+        '''
+        Parameters
+        ----------
+        folders
+            A dict of folder name to a list of RFC822 bytes, numbered from UID 1.
+        capabilities
+            Capabilities advertised before login.
+        login_capabilities
+            Capabilities advertised once logged in.
+        interleave
+            Hold this many pipelined UID FETCH commands and answer them together,
+            untagged responses for the last command first, then each tagged completion,
+            like a server working on them at once.
+        '''
+        super(ImapServer, self).__init__(('127.0.0.1', 0), ImapHandler)
+        self.port = self.server_address[1]
+        self.capabilities = capabilities
+        self.login_capabilities = login_capabilities
+        self.interleave = interleave
+        self.folders = {}
+        self.uidvalidity = {}
+        self.modseq = {}
+        self.commands = []
+        self.lock = threading.Lock()
+        for folder, bodies in (folders or {}).items():
+            self.create(folder)
+            for body in bodies:
+                self.append(folder, body)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def create(self, folder):
+        '''
+        Add an empty folder, or empty an existing one and give it a new UIDVALIDITY,
+        so identifiers from before are no longer valid.
+        '''
+        with self.lock:
+            self.uidvalidity[folder] = self.uidvalidity.get(folder, 0) + 1
+            self.folders[folder] = {}
+            self.modseq[folder] = self.modseq.get(folder, 0) + 1
+
+    def append(self, folder, body):
+        '''
+        Add an email to a folder.
+
+        Returns
+        -------
+        int
+            The UID of the new email.
+        '''
+        if folder not in self.folders:
+            self.create(folder)
+        with self.lock:
+            messages = self.folders[folder]
+            uid = max(messages, default=0) + 1
+            messages[uid] = body
+            self.modseq[folder] += 1
+            return uid
+
+    def expunge(self, folder, uid):
+        '''
+        Remove an email from a folder.
+        '''
+        with self.lock:
+            del self.folders[folder][uid]
+            self.modseq[folder] += 1
+
+    def close(self):
+        '''
+        Stop serving, and close the listening socket.
+        '''
+        self.shutdown()
+        self.server_close()
+
+
+class ImapHandler(socketserver.BaseRequestHandler):
+    '''
+    One IMAP session.
+    '''
+
+    def setup(self):
+        self.buffer = b''
+        self.logged_in = False
+        self.condstore = False
+        self.selected = None
+        # UID FETCH commands read, not yet answered, as (tag, arguments)
+        self.held = []
+
+    def send(self, *lines):
+        self.request.sendall(b''.join(line if isinstance(line, bytes) else line.encode('utf8') + b'\r\n' for line in lines))
+
+    def readline(self, timeout=None):
+        '''
+        The next command line, `None` when nothing arrives in `timeout` seconds,
+        or empty at the end of the session.
+        '''
+        while b'\n' not in self.buffer:
+            if timeout is not None and not select.select([self.request], [], [], timeout)[0]:
+                return None
+            data = self.request.recv(64 * 1024)
+            if not data:
+                return b''
+            self.buffer += data
+        line, self.buffer = self.buffer.split(b'\n', 1)
+        return line.rstrip(b'\r')
+
+    def handle(self):
+        self.send('* OK IMAP4rev1 ready')
+        while True:
+            line = self.readline(HOLD_WAIT if self.held else None)
+            if line is None:
+                self.answer()
+                continue
+            if not line:
+                return
+            tag, command, arguments = COMMAND.match(line.decode('utf8')).groups()
+            command = command.upper()
+            if command != 'CAPABILITY':
+                self.server.commands.append(' '.join(filter(None, (command, arguments))))
+            if command == 'UID' and arguments.upper().startswith('FETCH '):
+                self.held.append((tag, arguments[len('FETCH '):]))
+                if len(self.held) >= self.server.interleave:
+                    self.answer()
+                continue
+            self.answer()
+            if not getattr(self, 'do_' + command.lower(), self.do_unknown)(tag, arguments):
+                return
+
+    def answer(self):
+        '''
+        Answer held UID FETCH commands.
+        '''
+        held, self.held = self.held, []
+        for tag, arguments in reversed(held):
+            self.fetch(arguments)
+        for tag, _ in held:
+            self.send('{0} OK UID FETCH completed'.format(tag))
+
+    def fetch(self, arguments):
+        uids, parts = arguments.split(' ', 1)
+        messages = self.server.folders[self.selected]
+        numbers = {uid: number for number, uid in enumerate(sorted(messages), 1)}
+        fields = HEADER_FIELDS.search(parts)
+        for uid in uid_range(uids, messages):
+            body = messages[uid]
+            if fields:
+                names = fields.group(1).upper().split()
+                parsed = email.parser.BytesHeaderParser(policy=email.policy.compat32).parsebytes(body)
+                body = ''.join('{0}: {1}\r\n'.format(name, value) for name, value in parsed.items()
+                               if name.upper() in names).encode('utf8') + b'\r\n'
+                item = 'BODY[HEADER.FIELDS ({0})]'.format(fields.group(1).upper())
+            else:
+                item = 'RFC822'
+            self.send('* {0} FETCH (UID {1} {2} {{{3}}}\r\n'.format(numbers[uid], uid, item, len(body)).encode('utf8'),
+                      body, b')\r\n')
+
+    def do_capability(self, tag, arguments):
+        capabilities = self.server.login_capabilities if self.logged_in else self.server.capabilities
+        self.send('* CAPABILITY ' + ' '.join(capabilities), tag + ' OK CAPABILITY completed')
+        return True
+
+    def do_login(self, tag, arguments):
+        self.logged_in = True
+        self.send(tag + ' OK LOGIN completed')
+        return True
+
+    def do_enable(self, tag, arguments):
+        if not self.logged_in or 'ENABLE' not in self.server.login_capabilities:
+            self.send(tag + ' BAD ENABLE not supported')
+            return True
+        self.condstore = 'CONDSTORE' in arguments.upper().split() and 'CONDSTORE' in self.server.login_capabilities
+        self.send('* ENABLED' + (' CONDSTORE' if self.condstore else ''), tag + ' OK ENABLE completed')
+        return True
+
+    def do_select(self, tag, arguments):
+        folder = arguments.strip('"')
+        if folder not in self.server.folders:
+            self.send(tag + ' NO no such folder')
+            return True
+        self.selected = folder
+        messages = self.server.folders[folder]
+        self.send('* {0} EXISTS'.format(len(messages)),
+                  '* OK [UIDVALIDITY {0}]'.format(self.server.uidvalidity[folder]),
+                  '* OK [UIDNEXT {0}]'.format(max(messages, default=0) + 1))
+        if self.condstore:
+            self.send('* OK [HIGHESTMODSEQ {0}]'.format(self.server.modseq[folder]))
+        self.send(tag + ' OK [READ-WRITE] SELECT completed')
+        return True
+
+    do_examine = do_select
+
+    def do_uid(self, tag, arguments):
+        command, _, arguments = arguments.partition(' ')
+        if command.upper() != 'SEARCH':
+            return self.do_unknown(tag, arguments)
+        messages = self.server.folders[self.selected]
+        uids = re.search(r'UID (\S+)', arguments, re.IGNORECASE)
+        found = uid_range(uids.group(1), messages) if uids else sorted(messages)
+        self.send('* SEARCH' + ''.join(' {0}'.format(uid) for uid in found), tag + ' OK SEARCH completed')
+        return True
+
+    def do_noop(self, tag, arguments):
+        self.send(tag + ' OK NOOP completed')
+        return True
+
+    def do_logout(self, tag, arguments):
+        self.send('* BYE logging out', tag + ' OK LOGOUT completed')
+        return False
+
+    def do_unknown(self, tag, arguments):
+        self.send(tag + ' BAD unknown command')
+        return True
+
+
+def uid_range(uids, messages):
+    '''
+    UIDs in a folder matching an IMAP UID set, in order.
+
+    >>> uid_range('1:2,5:*', {1: b'', 2: b'', 3: b'', 7: b''})
+    [1, 2, 7]
+    >>> uid_range('9:*', {1: b'', 2: b''})
+    [2]
+    '''
+    highest = max(messages, default=0)
+    matched = set()
+    for part in uids.split(','):
+        low, _, high = part.partition(':')
+        low = highest if low == '*' else int(low)
+        high = low if not high else highest if high == '*' else int(high)
+        matched.update(uid for uid in messages if min(low, high) <= uid <= max(low, high))
+    return sorted(matched)
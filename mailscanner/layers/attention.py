@@ -68,8 +68,8 @@ class SelfAttention(Layer):
                                               kernel_initializer=self.kernel_initializer,
                                               kernel_regularizer=self.kernel_regularizer,
                                               kernel_constraint=self.kernel_constraint))
-        # make an attention vector
-        self.attention.add(keras.layers.Flatten())
+        # make an attention vector, reshape rather than flatten as time steps may vary
+        self.attention.add(keras.layers.Reshape((-1,)))
         self.attention.add(keras.layers.Activation('softmax'))
         # repeat this time step weighting for each dimensions
         self.attention.add(keras.layers.RepeatVector(dimensions))
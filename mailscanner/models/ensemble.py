@@ -18,6 +18,8 @@ class Ensemble(keras.models.Model):
     '''
     This uses pretty much every available technique in parallel to classify text.
 
+    Inputs can be any length, so batches of short text can be trimmed of padding.
+
     >>> import mailscanner
     >>> dataset = mailscanner.datasets.LabeledTextFileDataset('./var/data/labeled.txt') 
     >>> import mailscanner.models
@@ -25,21 +27,40 @@ class Ensemble(keras.models.Model):
     >>> m.save_weights('/tmp/m.model')
     >>> m = mailscanner.models.Ensemble(dataset)
     >>> m = m.load_weights('/tmp/m.model')
+    >>> from mailscanner.datasets.trigrams import trim
+    >>> mailscanner.models.Ensemble(dataset).predict(trim(dataset.texts)).shape
+    (2, 2)
     '''
 
-    def __init__(self, source_dataset):
+    def __init__(self, source_dataset, embed=True):
         '''
         Parameters
         ----------
-        source_dataset: `LabeledTextFileDataset`
-            Contains the source and target data to derive the shape and encoding of the model.
+        source_dataset: `LabeledTextFileDataset` or `InferenceCodec`
+            Contains the encoders to derive the shape and encoding of the model.
+        embed
+            When False, the model has no embedding layer, and takes sequences already
+            embedded, a vector for each ngram, so the large frozen embedding matrix
+            can be looked up outside tensorflow, say shared between server processes.
         '''
-        trigrams = source_dataset.trigram
-
-        inputs = keras.layers.Input(shape=(trigrams.maxlen,))
-
-        # embedding to turn ngram identifiers dense
-        embedded = trigrams.build_model()(inputs)
+        trigram = source_dataset.trigram
+        embeddings = getattr(trigram, 'embeddings', None)
+        shape = source_dataset.embedding_shape if embeddings is None else embeddings.shape
+
+        # any length up to trigram.maxlen, at least `datasets.trigrams.MIN_LENGTH`, see `datasets.trigrams.trim`
+        if embed:
+            inputs = keras.layers.Input(shape=(None,))
+            # embedding to turn ngram identifiers dense, the pretrained vectors as is,
+            # built here rather than by `trigram.build_model`, which fixes the input length
+            # a saved `InferenceCodec` has no vectors, they come with the trained weights
+            embedded = keras.layers.Embedding(
+                shape[0],
+                shape[1],
+                trainable=False,
+                weights=None if embeddings is None else [embeddings])(inputs)
+        else:
+            inputs = keras.layers.Input(shape=(None, shape[1]))
+            embedded = inputs
 
         # plain old dense
         dense = Dense(HIDDEN, 
@@ -2,25 +2,144 @@
 Given RFC822 text, parse email into a more structured format.
 '''
 
+import collections.abc
 import email
+import email.feedparser
+import email.message
+import functools
+import re
 from pathlib import Path
 
+# the blank line that ends the headers
+HEADERS_END = re.compile(r'\r?\n\r?\n')
+HEADERS_END_BYTES = re.compile(rb'\r?\n\r?\n')
 
-def parse(rfc822_string):
+# characters given to the parser at a time
+FEED_SIZE = 64 * 1024
+
+
+def parse(rfc822_string, headers_only=False, lazy=False, max_part_bytes=None):
     '''
+    >>> email = parse('Subject: Hello\\n\\nWorld')
+    >>> email['Subject'], email['text']
+    ('Hello', 'World')
+    >>> parse(b'Subject: Hello\\n\\nWorld', headers_only=True)
+    {'Subject': 'Hello'}
+
     Parameters
     ----------
     rfc822_string
-        Text of an email in RFC822 format.
+        Text, or bytes, of an email in RFC822 format.
+    headers_only
+        Only parse the headers, the body is not parsed at all, and there are
+        no `text` and `html` attributes.
+    lazy
+        Parse the headers now, but the body only when `text` or `html` is first accessed.
+    max_part_bytes
+        Keep at most this much of the body of each MIME part, the rest is dropped
+        as it is read, so large attachments are never held whole.
 
     Returns
     -------
     dict
         A dict of attributes, in (name, value) format for each header,
-        along with a `text` and `html` attributes for the body.
+        along with a `text` and `html` attributes for the body. When lazy,
+        a `LazyEmail`, which reads like the dict.
     '''
-    message = email.message_from_string(rfc822_string)
+    if lazy and not headers_only:
+        return LazyEmail(rfc822_string, max_part_bytes=max_part_bytes)
+    message = parse_message(rfc822_string, headers_only=headers_only, max_part_bytes=max_part_bytes)
     headers = list(map(parse_headers, message.items()))
+    if headers_only:
+        return dict(headers)
+    return dict(headers + parse_bodies(message))
+
+
+def parse_email(rfc822_string, max_part_bytes=None):
+    '''
+    >>> email = parse_email('Subject: Hello\\nX-Mailer: Test\\n\\nWorld')
+    >>> email.subject, email.text, email.headers
+    ('Hello', 'World', {'X-Mailer': 'Test'})
+    >>> email.to_text()
+    'Hello Test World '
+
+    Parameters
+    ----------
+    rfc822_string
+        Text, or bytes, of an email in RFC822 format.
+    max_part_bytes
+        Keep at most this much of each MIME part.
+
+    Returns
+    -------
+    ParsedEmail
+        A compact record of the email, with the commonly used headers as fields.
+    '''
+    message = parse_message(rfc822_string, max_part_bytes=max_part_bytes)
+    return ParsedEmail(map(parse_headers, message.items()), parse_bodies(message))
+
+
+def parse_message(rfc822_string, headers_only=False, max_part_bytes=None):
+    '''
+    >>> message = parse_message(b'Subject: Hello\\n\\nWorld', max_part_bytes=3)
+    >>> message['Subject'], message.get_payload()
+    ('Hello', 'Wor')
+
+    Parameters
+    ----------
+    rfc822_string
+        Text, or bytes, of an email in RFC822 format.
+    headers_only
+        Only parse the headers, the body is cut off before parsing, see `headers_of`.
+    max_part_bytes
+        Keep at most this much of the body of each MIME part.
+
+    Returns
+    -------
+    email.message.Message
+    '''
+    if headers_only:
+        rfc822_string = headers_of(rfc822_string)
+        max_part_bytes = 0
+    if isinstance(rfc822_string, bytes):
+        # as email.parser.BytesParser does, so bytes that are not ascii survive
+        rfc822_string = rfc822_string.decode('ascii', errors='surrogateescape')
+    factory = functools.partial(CappedMessage, max_part_bytes=max_part_bytes)
+    if max_part_bytes is None:
+        parser = email.feedparser.FeedParser(_factory=factory)
+    else:
+        parser = CappedFeedParser(max_part_bytes, _factory=factory)
+    if headers_only:
+        parser._set_headersonly()
+    # a piece at a time, so lines are parsed, and dropped past the cap, as they are split
+    for start in range(0, len(rfc822_string), FEED_SIZE):
+        parser.feed(rfc822_string[start:start + FEED_SIZE])
+    return parser.close()
+
+
+def headers_of(rfc822_string):
+    '''
+    Just the header block of an email, up to the blank line that ends it, or the
+    whole email when there is no blank line.
+
+    >>> headers_of(b'Subject: Hello\\r\\n\\r\\nWorld\\r\\n\\r\\nAgain')
+    b'Subject: Hello'
+    >>> headers_of('Subject: Hello\\nTo: you')
+    'Subject: Hello\\nTo: you'
+    '''
+    end = (HEADERS_END_BYTES if isinstance(rfc822_string, bytes) else HEADERS_END).search(rfc822_string)
+    return rfc822_string[:end.start()] if end else rfc822_string
+
+
+def parse_bodies(message):
+    '''
+    Collect the plain text and html parts of an email.
+
+    Returns
+    -------
+    list
+        The `text` and `html` (name, value) tuples.
+    '''
     message_text = []
     message_html = []
     for part in message.walk():
@@ -31,7 +150,7 @@ def parse(rfc822_string):
             message_html.append(part.get_payload())
     text = ('text', '\n'.join(message_text))
     html = ('html', '\n'.join(message_html))
-    return dict(headers + [text] + [html])
+    return [text, html]
 
 
 def parse_headers(header_tuple):
@@ -56,3 +175,188 @@ def parse_headers(header_tuple):
     if name == 'Date':
         value = email.utils.parsedate_tz(value)
     return (name, value)
+
+
+class CappedMessage(email.message.Message):
+    '''
+    An email message part that keeps at most `max_part_bytes` of its payload,
+    whatever sets it, see `CappedFeedParser` for the parser.
+    '''
+
+    def __init__(self, max_part_bytes=None, **kwargs):
+        super(CappedMessage, self).__init__(**kwargs)
+        self.max_part_bytes = max_part_bytes
+
+    def set_payload(self, payload, charset=None):
+        if self.max_part_bytes is not None and isinstance(payload, (str, bytes)):
+            payload = payload[:self.max_part_bytes]
+        super(CappedMessage, self).set_payload(payload, charset)
+
+
+class CappedFeedParser(email.feedparser.FeedParser):
+    '''
+    An email parser that reads at most `max_part_bytes` of the body of each MIME
+    part, the lines past that are dropped as they are read, rather than collected
+    and cut off once the part is complete. Headers are always read whole.
+    '''
+
+    def __init__(self, max_part_bytes=None, **kwargs):
+        super(CappedFeedParser, self).__init__(**kwargs)
+        self._input = CappedInput(max_part_bytes)
+
+    def _new_message(self):
+        # a part begins with its headers
+        self._input.remaining = None
+        super(CappedFeedParser, self)._new_message()
+
+    def _parse_headers(self, lines):
+        super(CappedFeedParser, self)._parse_headers(lines)
+        # and the rest is body
+        self._input.remaining = self._input.max_part_bytes
+
+    def _pop_message(self):
+        # back to the enclosing multipart, its boundaries and epilogue
+        self._input.remaining = None
+        return super(CappedFeedParser, self)._pop_message()
+
+
+class CappedInput(email.feedparser.BufferedSubFile):
+    '''
+    The lines of an email as `CappedFeedParser` reads them. Parts still end at
+    their boundary, as lines past the cap are still read, just not returned.
+    '''
+
+    def __init__(self, max_part_bytes=None):
+        super(CappedInput, self).__init__()
+        self.max_part_bytes = max_part_bytes
+        # characters left to return of the body being read, None when not capped
+        self.remaining = None
+
+    def __next__(self):
+        line = self.readline()
+        while self.remaining is not None and self.remaining <= 0 and line and line is not email.feedparser.NeedMoreData:
+            line = self.readline()
+        if line == '':
+            raise StopIteration
+        if self.remaining is not None and line is not email.feedparser.NeedMoreData:
+            line = line[:self.remaining]
+            self.remaining -= len(line)
+        return line
+
+
+class LazyEmail(collections.abc.Mapping):
+    '''
+    A parsed email that reads like the dict from `parse`, but only parses the
+    headers up front. The body is parsed, and `text` and `html` collected, only
+    when one of them is first accessed.
+    '''
+
+    def __init__(self, rfc822_string, max_part_bytes=None):
+        '''
+        Parameters
+        ----------
+        rfc822_string
+            Text, or bytes, of an email in RFC822 format.
+        max_part_bytes
+            Keep at most this much of each MIME part.
+        '''
+        self.rfc822_string = rfc822_string
+        self.max_part_bytes = max_part_bytes
+        message = parse_message(rfc822_string, headers_only=True)
+        self.headers = dict(map(parse_headers, message.items()))
+        self.bodies = None
+
+    def __getitem__(self, name):
+        if name in ('text', 'html'):
+            if self.bodies is None:
+                message = parse_message(self.rfc822_string, max_part_bytes=self.max_part_bytes)
+                self.bodies = dict(parse_bodies(message))
+                # all parsed, the source is no longer needed
+                self.rfc822_string = None
+            return self.bodies[name]
+        return self.headers[name]
+
+    def __iter__(self):
+        yield from self.headers
+        yield 'text'
+        yield 'html'
+
+    def __len__(self):
+        return len(self.headers) + 2
+
+
+class ParsedEmail:
+    '''
+    A parsed email, holding the commonly used headers as fields, and all the other
+    headers in `headers`. Uses slots, as corpus passes keep a lot of these around.
+
+    Attributes
+    ----------
+    message_id, in_reply_to, references, subject
+        Header strings, or None when not present.
+    sender, to, delivered_to
+        (name, address) tuples from `From`, `To` and `Delivered-To`, or None.
+    date
+        A `email.utils.parsedate_tz` tuple, or None.
+    text, html
+        Body text, joined across MIME parts.
+    headers
+        A dict of all other (name, value) headers, in the order they appeared.
+    '''
+
+    # header name, lower case, to field
+    FIELDS = {
+        'message-id': 'message_id',
+        'in-reply-to': 'in_reply_to',
+        'references': 'references',
+        'subject': 'subject',
+        'from': 'sender',
+        'to': 'to',
+        'delivered-to': 'delivered_to',
+        'date': 'date',
+    }
+
+    __slots__ = tuple(FIELDS.values()) + ('text', 'html', 'headers')
+
+    def __init__(self, headers=(), bodies=()):
+        '''
+        Parameters
+        ----------
+        headers
+            (name, value) header tuples, as from `parse_headers`.
+        bodies
+            (name, value) body tuples, as from `parse_bodies`.
+        '''
+        for field in self.FIELDS.values():
+            setattr(self, field, None)
+        self.text = ''
+        self.html = ''
+        self.headers = {}
+        for name, value in headers:
+            field = self.FIELDS.get(name.lower())
+            if field is None:
+                self.headers[name] = value
+            elif getattr(self, field) is None:
+                setattr(self, field, value)
+        for name, value in bodies:
+            setattr(self, name, value)
+
+    def __repr__(self):
+        return 'ParsedEmail(message_id={0!r}, subject={1!r})'.format(self.message_id, self.subject)
+
+    def to_text(self):
+        '''
+        All the header values and the body as one string, to extract features from.
+        Fields come first, in a fixed order, skipping those not present, then the
+        other headers in order, then the body.
+
+        Returns
+        -------
+        str
+        '''
+        values = [getattr(self, field) for field in self.FIELDS.values()]
+        values = [value for value in values if value is not None]
+        values.extend(self.headers.values())
+        values.append(self.text)
+        values.append(self.html)
+        return ' '.join(map(str, values))
@@ -0,0 +1,99 @@
+'''
+Asyncio server module, an alternative to `server` that holds many concurrent,
+keep alive connections in one process, and turns requests away with a 503 when
+predictions are backed up, rather than queueing them without limit.
+
+    python -m mailscanner.server.asyncserver
+'''
+
+import asyncio
+import concurrent.futures
+import os
+
+from aiohttp import web
+
+from ..datasets.trigrams import sequence
+from . import replies
+
+PORT = int(os.environ.get('PORT', 5000))
+# threads decoding and sequencing, and the most requests waiting on a prediction
+INFERENCE_THREADS = int(os.environ.get('INFERENCE_THREADS', 4))
+INFERENCE_QUEUE = int(os.environ.get('INFERENCE_QUEUE', 64))
+
+SERVER_IN = os.path.dirname(os.path.abspath(__file__))
+
+# the loop running the calling coroutine, python before 3.7 only has get_event_loop
+running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+
+async def rfc822(request):
+    '''
+    Classify one RFC822 email, the same as `replies.rfc822`.
+    '''
+    app = request.app
+    body = (await request.read()).decode('utf8')
+    key = replies.cache_key(body)
+    decode = replies.CACHE.get(key)
+    if decode is None:
+        if app['pending'] >= INFERENCE_QUEUE:
+            return web.json_response({'error': 'busy, try again'}, status=503, headers={'Retry-After': '1'})
+        app['pending'] += 1
+        try:
+            loop = running_loop()
+            sequenced = await loop.run_in_executor(app['executor'], sequence, replies.CODEC.trigram, [body])
+            # batched with other requests, waiting without holding a thread
+            predicted = await asyncio.wrap_future(replies.BATCHER.submit(sequenced[0]))
+        finally:
+            app['pending'] -= 1
+        decode = replies.CODEC.decode_prediction(predicted)
+        replies.CACHE.put(key, decode)
+    return web.json_response({
+        # cast off the numpy types
+        'label': str(decode[0]),
+        'score': float(decode[1])
+    })
+
+
+async def cache_stats(request):
+    '''
+    Hits, misses and size of the classification cache.
+    '''
+    return web.json_response(dict(replies.cache_stats(), pending=request.app['pending']))
+
+
+async def warm_up(app):
+    '''
+    Build the model and predict once before serving.
+    '''
+    await running_loop().run_in_executor(app['executor'], replies.warm_up)
+
+
+async def shut_down(app):
+    app['executor'].shutdown(wait=False)
+
+
+def application():
+    '''
+    Create the aiohttp application, loading the codec and weights.
+
+    Returns
+    -------
+    aiohttp.web.Application
+    '''
+    # prefer the slim inference codec, a whole pickled dataset works too
+    codec = os.path.join(SERVER_IN, '../../var/data/replies.codec')
+    if not os.path.exists(codec):
+        codec = os.path.join(SERVER_IN, '../../var/data/replies.pickle')
+    replies.load_model_codec(os.path.join(SERVER_IN, '../../var/data/replies.weights'), codec)
+    app = web.Application()
+    app['executor'] = concurrent.futures.ThreadPoolExecutor(INFERENCE_THREADS)
+    app['pending'] = 0
+    app.router.add_post('/replies/rfc822/classify', rfc822)
+    app.router.add_get('/replies/cache/stats', cache_stats)
+    app.on_startup.append(warm_up)
+    app.on_cleanup.append(shut_down)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(application(), port=PORT)
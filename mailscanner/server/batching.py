@@ -0,0 +1,130 @@
+'''
+Collect concurrent predictions into batches, as predicting many texts at once
+is much quicker than predicting them one at a time.
+'''
+
+import concurrent.futures
+import os
+import queue
+import threading
+import time
+
+import numpy as np
+
+from ..datasets.trigrams import bucketed, lengths, trim
+
+# seconds to wait for more requests to join a batch, and the most in a batch
+BATCH_WINDOW = float(os.environ.get('BATCH_WINDOW', 0.005))
+BATCH_SIZE = int(os.environ.get('BATCH_SIZE', 32))
+
+
+class MicroBatcher:
+    '''
+    Predict sequenced texts from any number of threads, in batches. The first text
+    waits up to `window` seconds for others to join it, or until there are `size`
+    of them, then one predict runs for the batch, and each caller gets its own row.
+
+    A longer window and larger size make for more throughput under load, at the
+    cost of latency for each request.
+
+    Texts are predicted together only with others of the same length bucket, see
+    `trigrams.bucket`, so each is padded just as when predicted alone, and its
+    prediction does not depend on what else arrived at the same time.
+
+    >>> batcher = MicroBatcher(lambda batch: batch.sum(axis=1))
+    >>> int(batcher.predict(np.ones(64, dtype=np.int32)))
+    64
+    >>> batcher = MicroBatcher(lambda batch: np.full(len(batch), batch.shape[1]), window=0.1)
+    >>> short, long = np.zeros(1024, dtype=np.int32), np.zeros(1024, dtype=np.int32)
+    >>> short[:10], long[:500] = 1, 1
+    >>> futures = [batcher.submit(short), batcher.submit(long)]
+    >>> [int(future.result()) for future in futures]
+    [32, 512]
+    '''
+
+    def __init__(self, predict, window=BATCH_WINDOW, size=BATCH_SIZE):
+        '''
+        Parameters
+        ----------
+        predict
+            A function of a batch of sequenced texts, returning a prediction for each,
+            say `model.predict`.
+        window
+            Seconds the first text in a batch waits for more, 0 to predict each text alone.
+        size
+            The most texts in a batch.
+        '''
+        self._predict = predict
+        self.window = window
+        self.size = size
+        self.queue = queue.Queue()
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def predict(self, row):
+        '''
+        Predict one sequenced text, waiting on the batch it joins.
+
+        Parameters
+        ----------
+        row
+            A 1-d array of ngram identifiers.
+
+        Returns
+        -------
+        The prediction for the text.
+        '''
+        if self.window <= 0 or self.size <= 1:
+            return self._predict(trim(row[np.newaxis]))[0]
+        return self.submit(row).result()
+
+    def submit(self, row):
+        '''
+        Queue one sequenced text to be predicted in a batch.
+
+        Returns
+        -------
+        concurrent.futures.Future
+            Resolves to the prediction for the text.
+        '''
+        self.start()
+        future = concurrent.futures.Future()
+        self.queue.put((row, future))
+        return future
+
+    def start(self):
+        '''
+        Start the thread that runs batches, once in each process, as threads
+        do not carry over when a server forks workers.
+        '''
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.queue = queue.Queue()
+                threading.Thread(target=self.run, args=(self.queue,), daemon=True).start()
+
+    def run(self, requests):
+        '''
+        Collect and predict batches, forever.
+        '''
+        while True:
+            batch = [requests.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            rows = np.stack([row for row, _ in batch])
+            for group in bucketed(lengths(rows), self.size, rows.shape[1], shuffle=False):
+                try:
+                    predicted = self._predict(trim(rows[group]))
+                except Exception as error:
+                    for number in group:
+                        batch[number][1].set_exception(error)
+                    continue
+                for number, prediction in zip(group, predicted):
+                    batch[number][1].set_result(prediction)
@@ -0,0 +1,94 @@
+'''
+Remember recent classifications, as the same email is often sent again.
+'''
+
+import collections
+import os
+import threading
+import time
+
+# most results kept, 0 to not cache, and seconds each is kept
+CACHE_SIZE = int(os.environ.get('CACHE_SIZE', 10000))
+CACHE_TTL = float(os.environ.get('CACHE_TTL', 3600))
+
+
+class PredictionCache:
+    '''
+    A least recently used cache, with a limit on both the number of entries and
+    how long each is kept, safe to use from many threads, that counts hits and misses.
+
+    >>> cache = PredictionCache(size=1)
+    >>> cache.get('a') is None
+    True
+    >>> cache.put('a', 1)
+    >>> cache.put('b', 2)
+    >>> cache.get('a') is None, cache.get('b')
+    (True, 2)
+    >>> cache.stats()
+    {'hits': 1, 'misses': 2, 'evictions': 1, 'expirations': 0, 'entries': 1, 'size': 1, 'ttl': 3600.0}
+    '''
+
+    def __init__(self, size=CACHE_SIZE, ttl=CACHE_TTL):
+        '''
+        Parameters
+        ----------
+        size
+            Most entries kept, the least recently used go first, 0 to keep none.
+        ttl
+            Seconds an entry is kept.
+        '''
+        self.size = size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.counts = collections.Counter(hits=0, misses=0, evictions=0, expirations=0)
+
+    def get(self, key):
+        '''
+        Returns
+        -------
+        The cached value, or None.
+        '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < time.monotonic():
+                del self.entries[key]
+                self.counts['expirations'] += 1
+                entry = None
+            if entry is None:
+                self.counts['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counts['hits'] += 1
+            return entry[1]
+
+    def put(self, key, value):
+        '''
+        Remember a value, dropping the least recently used when full.
+        '''
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.counts['evictions'] += 1
+
+    def clear(self):
+        '''
+        Forget everything, say when the model changes.
+        '''
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        '''
+        Returns
+        -------
+        dict
+            Counts of hits, misses, evictions and expirations, along with the
+            number of entries and the limits.
+        '''
+        with self.lock:
+            return dict(self.counts, entries=len(self.entries), size=self.size, ttl=self.ttl)
@@ -0,0 +1,26 @@
+'''
+Gunicorn settings, use with `gunicorn -c python:mailscanner.server.gunicorn_config`.
+
+The application, with the codec and model weights, is loaded once in the master,
+so the workers it forks do not read them again. The weights are memory mapped, so
+the large trigram embedding, which is looked up outside tensorflow, is held once for
+all workers. Each worker then builds its model, as tensorflow does not survive a
+fork, copying in just the small weights of the other layers, and warms up with a
+predict before it takes any requests.
+'''
+
+preload_app = True
+
+
+def post_worker_init(worker):
+    '''
+    Build and warm up the model in a worker, before it accepts requests.
+
+    A sync worker, the default with one thread, serves one request at a time, so
+    there is never another to batch with, and requests do not wait on a batch window.
+    '''
+    from gunicorn.workers.sync import SyncWorker
+    from . import replies
+    if isinstance(worker, SyncWorker):
+        replies.BATCHER.window = 0
+    replies.warm_up()
@@ -2,8 +2,32 @@
 Individual email handling methods.
 '''
 
-from ..datasets import LabeledTextFileDataset
+import hashlib
+import itertools
+import json
+import os
+import threading
+
+import flask
+import h5py
+import numpy as np
+import tensorflow
+from keras.engine.saving import preprocess_weights_for_loading
+
+from ..datasets import InferenceCodec
+from ..datasets.trigrams import bucketed, lengths, sequence, trim
 from ..models import Ensemble
+from ..parser import parse_message
+from .batching import MicroBatcher
+from .caching import PredictionCache
+from .uploads import READERS
+
+# emails read from a bulk upload at a time, and the most predicted at once
+BULK_SIZE = 1024
+PREDICT_SIZE = 128
+
+# results are cached by a hash of the body, or by 'message-id' when there is one
+CACHE_KEY = os.environ.get('CACHE_KEY', 'body')
 
 # preload this, it has a large tensor inside
 # connexion only allows module level functions as handlers
@@ -11,19 +35,199 @@ from ..models import Ensemble
 # -- beats loading in on every request!
 MODEL = None
 CODEC = None
+BATCHER = None
+GRAPH = None
+CACHE = PredictionCache()
+# identifies the loaded weights, part of each cache key, so a new model misses
+WEIGHTS = None
+# the frozen trigram embedding, memory mapped from the weights file and looked up
+# with numpy, so every process shares one copy, and the weights of the other layers,
+# see `read_weights`, along with the process the model was built in, as tensorflow
+# does not survive a fork
+EMBEDDINGS = None
+LAYER_WEIGHTS = None
+MODEL_PID = None
+MODEL_LOCK = threading.Lock()
 
 def load_model_codec(path_to_weights, path_to_codec):
     '''
-    Load up the module level variables for the codec/dataset
-    and the trained machine learning model.
+    Load up the module level variables for the codec
+    and the trained machine learning model weights.
+
+    Only the `InferenceCodec` is kept, even when given a whole saved dataset.
+
+    This does not use tensorflow, so it can run in a server before it forks workers.
+    Weights are memory mapped, not read, so the pages of the file are shared by every
+    process. The model is built in each process, by `load_model`, or when first used,
+    without its embedding layer. The small weights of the other layers are copied into
+    tensorflow, while the large embedding matrix is looked up from the memory map, so
+    is held once, however many workers there are.
+
+    As the weights file is memory mapped, replace it by moving a new file into place,
+    rather than writing over it while a server is running.
     '''
-    global CODEC, MODEL
+    global CODEC, MODEL, BATCHER, WEIGHTS, EMBEDDINGS, LAYER_WEIGHTS
     print('loading codec from', path_to_codec)
-    CODEC = LabeledTextFileDataset.load(path_to_codec)
+    CODEC = InferenceCodec.load(path_to_codec)
     print('loading weights from', path_to_weights)
-    MODEL = Ensemble(CODEC)
-    MODEL.load_weights(path_to_weights)
-    print(MODEL.summary())
+    EMBEDDINGS, LAYER_WEIGHTS = split_embedding(read_weights(path_to_weights), CODEC.embedding_shape)
+    weights = os.stat(path_to_weights)
+    WEIGHTS = '{0}:{1}:{2}'.format(os.path.abspath(path_to_weights), weights.st_mtime_ns, weights.st_size)
+    CACHE.clear()
+    MODEL = None
+    BATCHER = MicroBatcher(predict)
+
+
+def read_weights(path_to_weights):
+    '''
+    Read weights saved by keras `save_weights`, straight from the HDF5 file, each
+    memory mapped when it can be, see `mapped`.
+
+    Returns
+    -------
+    dict
+        `layers`, a list of (layer name, list of numpy arrays) for each layer that
+        has weights, in saved order, along with the `keras_version` and `backend`
+        that saved them, see `set_weights`.
+    '''
+    with h5py.File(path_to_weights, 'r') as weights_file:
+        if 'layer_names' not in weights_file.attrs and 'model_weights' in weights_file:
+            weights_file = weights_file['model_weights']
+        attrs = weights_file.attrs
+        layers = []
+        for layer_name in attrs['layer_names']:
+            group = weights_file[layer_name]
+            weights = [mapped(path_to_weights, group[weight_name]) for weight_name in group.attrs['weight_names']]
+            if weights:
+                layers.append((decoded(layer_name), weights))
+        return {
+            'layers': layers,
+            # as keras `load_weights` reads them
+            'keras_version': decoded(attrs['keras_version']) if 'keras_version' in attrs else '1',
+            'backend': decoded(attrs['backend']) if 'backend' in attrs else None,
+        }
+
+
+def mapped(path, dataset):
+    '''
+    An HDF5 dataset as a read only memory map of its file, so every process using it
+    shares the same pages, or read into memory when it is not stored in one piece.
+    '''
+    offset = dataset.id.get_offset()
+    if offset is None or dataset.chunks is not None:
+        return np.asarray(dataset)
+    return np.memmap(path, dtype=dataset.dtype, mode='r', offset=offset, shape=dataset.shape)
+
+
+def split_embedding(saved, shape):
+    '''
+    Take the frozen trigram embedding out of weights from `read_weights`, it is
+    the layer with a single weight of the embedding shape.
+
+    Returns
+    -------
+    tuple
+        The embedding matrix, and the weights of the other layers, for an `Ensemble`
+        built with `embed=False`.
+    '''
+    for number, (name, weights) in enumerate(saved['layers']):
+        if len(weights) == 1 and weights[0].shape == tuple(shape):
+            return weights[0], dict(saved, layers=saved['layers'][:number] + saved['layers'][number + 1:])
+    raise ValueError('no embedding of shape {0} in the weights, of layers {1}'.format(
+        tuple(shape), [name for name, _ in saved['layers']]))
+
+
+def decoded(value):
+    '''
+    HDF5 attributes may be bytes or text, this is always text.
+    '''
+    return value.decode('utf8') if isinstance(value, bytes) else value
+
+
+def set_weights(model, saved):
+    '''
+    Set the weights of a model from `read_weights`, the same as keras `load_weights`.
+
+    Layers are matched by name, or when the names differ, say as keras numbers
+    layers by how many were built before in the process, by order. Weights are
+    converted from the keras version and backend that saved them.
+
+    Parameters
+    ----------
+    model
+        A keras model.
+    saved
+        Weights from `read_weights`.
+    '''
+    layers = [layer for layer in model.layers if layer.weights]
+    names = [name for name, _ in saved['layers']]
+    by_name = {layer.name: layer for layer in layers}
+    if sorted(names) == sorted(by_name):
+        layers = [by_name[name] for name in names]
+    elif len(layers) != len(names):
+        raise ValueError('weights are for {0} layers, named {1}, the model has {2}, named {3}'.format(
+            len(names), names, len(layers), [layer.name for layer in layers]))
+    for layer, (name, weights) in zip(layers, saved['layers']):
+        weights = preprocess_weights_for_loading(layer, weights, saved['keras_version'], saved['backend'])
+        if len(weights) != len(layer.weights):
+            raise ValueError('layer {0} has {1} weights, those saved for {2} have {3}'.format(
+                layer.name, len(layer.weights), name, len(weights)))
+        layer.set_weights(weights)
+
+
+def load_model():
+    '''
+    Build the model in this process, from the loaded weights, if not already built.
+    The model takes embedded sequences, see `predict`.
+
+    Returns
+    -------
+    Ensemble
+    '''
+    global MODEL, MODEL_PID, GRAPH
+    with MODEL_LOCK:
+        if MODEL is None or MODEL_PID != os.getpid():
+            model = Ensemble(CODEC, embed=False)
+            set_weights(model, LAYER_WEIGHTS)
+            print(model.summary())
+            # batches run on their own thread, which needs to be told the graph of the model
+            GRAPH = tensorflow.get_default_graph()
+            MODEL, MODEL_PID = model, os.getpid()
+        return MODEL
+
+
+def warm_up():
+    '''
+    Build the model and predict once, so the first request does not wait on that.
+    '''
+    predict(trim(sequence(CODEC.trigram, ['warm up'])))
+
+
+def predict(batch):
+    '''
+    Predict a batch of sequenced text with the loaded model, from any thread.
+    '''
+    model = load_model()
+    # the embedding is looked up here, from the shared memory map
+    embedded = EMBEDDINGS[batch]
+    with GRAPH.as_default():
+        return model.predict(embedded)
+
+
+def cache_key(body):
+    '''
+    The key for the classification of an email in `CACHE`.
+
+    Parameters
+    ----------
+    body
+        An entire RFC822 string.
+    '''
+    if CACHE_KEY == 'message-id':
+        message_id = parse_message(body, headers_only=True)['Message-ID']
+        if message_id:
+            return (WEIGHTS, 'message-id', message_id.strip())
+    return (WEIGHTS, 'sha1', hashlib.sha1(body.encode('utf8', errors='replace')).hexdigest())
 
 
 def rfc822(body):
@@ -39,14 +243,143 @@ def rfc822(body):
         JSON string encoding the classification result.
     '''
 
-    # text, sequenced as ngram, ready to be predicted
     body = body.decode('utf8')
-    sequenced = CODEC.trigram.sequencer.transform([body])
-    predicted = MODEL.predict(sequenced)
-    decode = CODEC.decode_prediction(predicted[0])
+    key = cache_key(body)
+    decode = CACHE.get(key)
+    if decode is None:
+        # text, sequenced as ngram, ready to be predicted
+        sequenced = sequence(CODEC.trigram, [body])
+        # predicted along with any other concurrent requests, each batch only as long as
+        # its longest text, as short email is quicker to predict
+        predicted = BATCHER.predict(sequenced[0])
+        decode = CODEC.decode_prediction(predicted)
+        CACHE.put(key, decode)
 
     return {
         'label': decode[0],
         # cast off the numpy type
         'score': float(decode[1])
     }
+
+
+def cache_stats():
+    '''
+    Returns
+    -------
+    dict
+        Hits, misses and size of the classification cache.
+    '''
+    return CACHE.stats()
+
+
+def batch():
+    '''
+    Classify many emails in one request, read from the upload as it arrives, and
+    streamed back as they are classified, so neither side holds them all.
+
+    The upload is a JSON array of RFC822 strings, newline delimited JSON strings,
+    or an mbox, by its content type, see `uploads.READERS`.
+
+    This is a plain Flask view, see `add_routes`, as connexion reads the whole
+    body before calling an operation. The first emails are classified before the
+    response starts, so an upload that is malformed from the start is a 400, one
+    that goes bad later ends with an `error` line.
+
+    >>> import contextlib, io, connexion, mailscanner
+    >>> dataset = mailscanner.datasets.LabeledTextFileDataset('./var/data/labeled.txt')
+    >>> dataset.codec().save('/tmp/labeled.codec')
+    >>> mailscanner.models.Ensemble(dataset).save_weights('/tmp/labeled.weights')
+    >>> with contextlib.redirect_stdout(io.StringIO()):
+    ...     load_model_codec('/tmp/labeled.weights', '/tmp/labeled.codec')
+    ...     warm_up()
+    >>> application = connexion.App(__name__, specification_dir=os.path.dirname(__file__))
+    >>> api = application.add_api('api.yml')
+    >>> add_routes(application)
+    >>> client = application.app.test_client()
+    >>> response = client.post('/replies/batch/classify', data=b'"Subject: one"\\n"Subject: two"\\n',
+    ...                        content_type='application/x-ndjson')
+    >>> [json.loads(line)['index'] for line in response.data.splitlines()]
+    [0, 1]
+    >>> response = client.post('/replies/batch/classify', data=b'From a\\nSubject: one\\n',
+    ...                        content_type='application/mbox')
+    >>> [json.loads(line)['index'] for line in response.data.splitlines()]
+    [0]
+    >>> client.post('/replies/batch/classify', data=b'["Subject: one"', content_type='application/json').status_code
+    400
+
+    Returns
+    -------
+    flask.Response
+        Newline delimited JSON, an object for each email in upload order, with the
+        `index` of the email, its `message_id`, and the `label` and `score`.
+    '''
+    reader = READERS.get(flask.request.mimetype)
+    if reader is None:
+        return flask.jsonify(error='unsupported content type {0}'.format(flask.request.mimetype)), 415
+    results = classify(reader(flask.request.stream))
+    try:
+        first = list(itertools.islice(results, 1))
+    except ValueError as error:
+        return flask.jsonify(error=str(error)), 400
+
+    def lines():
+        try:
+            for result in itertools.chain(first, results):
+                yield json.dumps(result) + '\n'
+        except ValueError as error:
+            yield json.dumps({'error': str(error)}) + '\n'
+
+    # the upload is still being read as the response streams
+    return flask.Response(flask.stream_with_context(lines()), mimetype='application/x-ndjson')
+
+
+def add_routes(application):
+    '''
+    Add the routes that are not connexion operations in `api.yml` to a connexion
+    application, that is `/replies/batch/classify`, see `batch`.
+    '''
+    application.app.add_url_rule('/replies/batch/classify', 'batch', batch, methods=['POST'])
+
+
+def classify(emails):
+    '''
+    Classify emails, a large chunk at a time, predicting texts of about the same
+    length together.
+
+    Parameters
+    ----------
+    emails
+        An iterable of RFC822 strings or bytes.
+
+    Returns
+    -------
+    generator
+        Yields a dict for each email, in order.
+    '''
+    emails = iter(emails)
+    index = 0
+    while True:
+        chunk = [
+            email.decode('utf8', errors='replace') if isinstance(email, bytes) else email
+            for email in itertools.islice(emails, BULK_SIZE)]
+        if not chunk:
+            break
+        keys = [cache_key(email) for email in chunk]
+        decoded = [CACHE.get(key) for key in keys]
+        # only sequence and predict what is not cached
+        misses = [number for number, decode in enumerate(decoded) if decode is None]
+        if misses:
+            sequenced = sequence(CODEC.trigram, [chunk[number] for number in misses])
+            for group in bucketed(lengths(sequenced), PREDICT_SIZE, sequenced.shape[1], shuffle=False):
+                for number, prediction in zip(group, predict(trim(sequenced[group]))):
+                    decoded[misses[number]] = CODEC.decode_prediction(prediction)
+                    CACHE.put(keys[misses[number]], decoded[misses[number]])
+        for email, (label, score) in zip(chunk, decoded):
+            yield {
+                'index': index,
+                'message_id': parse_message(email, headers_only=True)['Message-ID'],
+                # cast off the numpy types
+                'label': str(label),
+                'score': float(score)
+            }
+            index += 1
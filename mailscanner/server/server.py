@@ -16,10 +16,16 @@ SERVER_IN = os.path.dirname(os.path.abspath(__file__))
 # WSGI module level variable
 application = connexion.App(__name__, port=PORT, specification_dir=SERVER_IN)
 application.add_api('api.yml')
+mailscanner.server.replies.add_routes(application)
+# prefer the slim inference codec, a whole pickled dataset works too
+CODEC = os.path.join(SERVER_IN, '../../var/data/replies.codec')
+if not os.path.exists(CODEC):
+    CODEC = os.path.join(SERVER_IN, '../../var/data/replies.pickle')
 mailscanner.server.replies.load_model_codec(
     os.path.join(SERVER_IN, '../../var/data/replies.weights'),
-    os.path.join(SERVER_IN, '../../var/data/replies.pickle')
+    CODEC
 )
 
 if __name__ == '__main__':
+    mailscanner.server.replies.warm_up()
     application.run(debug=DEBUG)
@@ -0,0 +1,122 @@
+'''
+Read many emails from an upload as it arrives, rather than all at once.
+'''
+
+import codecs
+import json
+
+# bytes read from an upload at a time, at least
+CHUNK_SIZE = 64 * 1024
+
+
+def json_array(stream):
+    '''
+    Read a JSON array of RFC822 strings.
+
+    >>> import io
+    >>> list(json_array(io.BytesIO(b' ["Subject: one", "Subject: two"] ')))
+    ['Subject: one', 'Subject: two']
+
+    Parameters
+    ----------
+    stream
+        A binary file like object.
+
+    Returns
+    -------
+    generator
+        Yields each string as soon as it has all arrived.
+    '''
+    decoder = json.JSONDecoder()
+    text = codecs.getincrementaldecoder('utf8')()
+    buffer = ''
+    state = 'start'
+    while True:
+        buffer = buffer.lstrip()
+        if buffer:
+            if state == 'start':
+                if buffer[0] != '[':
+                    raise ValueError('expected a JSON array')
+                buffer, state = buffer[1:], 'first'
+                continue
+            if state in ('first', 'next') and buffer[0] == ']':
+                return
+            if state == 'next':
+                if buffer[0] != ',':
+                    raise ValueError('expected , between emails')
+                buffer, state = buffer[1:], 'value'
+                continue
+            try:
+                value, end = decoder.raw_decode(buffer)
+            except ValueError:
+                # not all here yet
+                pass
+            else:
+                if not isinstance(value, str):
+                    raise ValueError('expected each email to be a string')
+                yield value
+                buffer, state = buffer[end:], 'next'
+                continue
+        # read at least as much again as is waiting, so a large email is not decoded over and over
+        chunk = stream.read(max(CHUNK_SIZE, len(buffer)))
+        if not chunk:
+            raise ValueError('JSON array ended early')
+        buffer += text.decode(chunk)
+
+
+def ndjson(stream):
+    '''
+    Read newline delimited JSON, a JSON RFC822 string on each line.
+
+    >>> import io
+    >>> list(ndjson(io.BytesIO(b'"Subject: one"\\n\\n"Subject: two"\\n')))
+    ['Subject: one', 'Subject: two']
+    '''
+    for line in stream:
+        if line.strip():
+            value = json.loads(line.decode('utf8'))
+            if not isinstance(value, str):
+                raise ValueError('expected each email to be a string')
+            yield value
+
+
+def mbox(stream):
+    '''
+    Read an mbox, splitting emails on the `From ` line that begins each one.
+
+    >>> import io
+    >>> list(mbox(io.BytesIO(b'From a\\nSubject: one\\n\\nFrom b\\nSubject: two\\n')))
+    [b'Subject: one\\n', b'Subject: two\\n']
+
+    Returns
+    -------
+    generator
+        Yields RFC822 bytes for each email, less the `From ` line.
+    '''
+    lines = None
+    for line in stream:
+        if line.startswith(b'From '):
+            if lines is not None:
+                yield separated(lines)
+            lines = []
+        elif lines is not None:
+            lines.append(line)
+    if lines is not None:
+        yield separated(lines)
+
+
+def separated(lines):
+    '''
+    Join the lines of an email from an mbox, less the blank line before the next `From `.
+    '''
+    if lines and not lines[-1].strip():
+        lines = lines[:-1]
+    return b''.join(lines)
+
+
+# read an upload by its content type
+READERS = {
+    'application/json': json_array,
+    'application/x-ndjson': ndjson,
+    'application/mbox': mbox,
+}
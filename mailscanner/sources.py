@@ -2,27 +2,160 @@
 Classes to connect and download email to a database for further processing.
 '''
 
+import collections
+import copy
+import functools
 import imaplib
+import itertools
+import mmap
+import multiprocessing
 import os
+import queue
+import re
+import threading
+import time
 
 from tqdm import tqdm
 
+from .databases import BATCH_SIZE, body_key, keyed_bodies
+from .parser import headers_of
+
 # you may have a LOT of email, so take this limit up
 imaplib._MAXLINE = 16 * 1024 * 1024
 
+# emails requested per UID FETCH, and number of those fetches kept in flight
+CHUNK_SIZE = 128
+PIPELINE = 4
+
+# seconds between checks that a parallel fetch has been stopped
+STOP_POLL = 0.1
+
+# what to FETCH for entire emails, and the headers needed to find replies
+RFC822 = '(RFC822)'
+REPLY_HEADERS = ['Message-ID', 'In-Reply-To', 'References']
+
+FETCH_UID = re.compile(rb'UID (\d+)')
+
+# Google Takeout marks sent email with a label
+TAKEOUT_SENT = re.compile(rb'^X-Gmail-Labels:[^\r\n]*\bSent\b', re.MULTILINE | re.IGNORECASE)
+
+# each import worker process gets the database codec once
+_CODEC = None
+
 
 class MailSource:
     '''
     Base mail connector.
 
     Errors will propagate from imaplib, raising imaplib.IMAP4.error.
+
+    Attributes
+    ----------
+    FOLDERS
+        A list of (database table, IMAP folder) tuples that `download` will fill.
     '''
 
-    def __init__(self, host, username, password):
-        self.mail = imaplib.IMAP4_SSL(host)
-        self.mail.login(username, password)
+    FOLDERS = []
 
-    def identifiers(self, folder):
+    def __init__(self, host, username, password, port=None, ssl=True):
+        '''
+        Parameters
+        ----------
+        host
+            IMAP server host name.
+        username
+            Login name.
+        password
+            Login password.
+        port
+            Server port, defaults to the standard IMAP port.
+        ssl
+            Set to `False` to connect without SSL, say to a local IMAP server.
+        '''
+        self._server = (host, port, ssl)
+        self._credentials = (username, password)
+        self.mail = self.connect()
+
+    def connect(self):
+        '''
+        Open a new, logged in, IMAP session, with CONDSTORE enabled when the server has it.
+
+        >>> from mailscanner.imapserver import ImapServer
+        >>> server = ImapServer({'INBOX': []})
+        >>> MailSource('127.0.0.1', 'user', 'password', port=server.port, ssl=False).select('INBOX')
+        (1, 1)
+        >>> server.close()
+        >>> server = ImapServer({'INBOX': []}, login_capabilities=('IMAP4rev1', 'CONDSTORE'))
+        >>> MailSource('127.0.0.1', 'user', 'password', port=server.port, ssl=False).select('INBOX')
+        (1, None)
+        >>> server.close()
+
+        Returns
+        -------
+        imaplib.IMAP4
+        '''
+        host, port, ssl = self._server
+        imap = imaplib.IMAP4_SSL if ssl else imaplib.IMAP4
+        mail = imap(host, port) if port else imap(host)
+        mail.login(*self._credentials)
+        # servers like Gmail only advertise ENABLE and CONDSTORE once logged in,
+        # but imaplib checks what was advertised before, so that is refreshed here
+        _, capabilities = mail.capability()
+        mail.capabilities = tuple(capabilities[-1].decode('ascii').upper().split())
+        # with CONDSTORE, selecting a folder reports HIGHESTMODSEQ, without ENABLE it is just not used
+        if 'CONDSTORE' in mail.capabilities and 'ENABLE' in mail.capabilities:
+            mail.enable('CONDSTORE')
+        return mail
+
+    def clone(self):
+        '''
+        A copy of this source on its own, independent, IMAP session.
+        '''
+        source = copy.copy(self)
+        source.mail = self.connect()
+        return source
+
+    def select(self, folder):
+        '''
+        Select a folder, reporting its synchronization status.
+
+        Parameters
+        ----------
+        folder
+            A string naming the folder.
+
+        Returns
+        -------
+        tuple
+            (uidvalidity, modseq), modseq is `None` when the server lacks CONDSTORE.
+        '''
+        self.mail.select(folder)
+        _, uidvalidity = self.mail.response('UIDVALIDITY')
+        _, modseq = self.mail.response('HIGHESTMODSEQ')
+        return (int(uidvalidity[-1]), int(modseq[-1]) if modseq and modseq[-1] else None)
+
+    def search(self, since=0):
+        '''
+        Identifiers in the selected folder.
+
+        Parameters
+        ----------
+        since
+            Only identifiers greater than this are returned.
+
+        Returns
+        -------
+        list
+            A list of email identifiers.
+        '''
+        if since:
+            # n:* always matches the highest UID, even when that is below n
+            _, data = self.mail.uid('search', None, 'UID', '{0}:*'.format(since + 1))
+            return [uid for uid in data[0].split() if int(uid) > since]
+        _, data = self.mail.uid('search', None, "ALL")
+        return data[0].split()
+
+    def identifiers(self, folder, since=0):
         '''
         General email identity fetcher.
 
@@ -30,6 +163,8 @@ class MailSource:
         ----------
         folder
             A string naming the folder to fetch all identifiers.
+        since
+            Only identifiers greater than this are returned.
 
         Returns
         -------
@@ -37,10 +172,8 @@ class MailSource:
             A list of email identifiers.
 
         '''
-        self.mail.select(folder)
-        _, data = self.mail.uid('search', None, "ALL")
-        email_identifiers = data[0].split()
-        return email_identifiers
+        self.select(folder)
+        return self.search(since)
 
     def __getitem__(self, email_identifier):
         '''
@@ -53,8 +186,216 @@ class MailSource:
         '''
         _, data = self.mail.uid('fetch', email_identifier, '(RFC822)')
         return data[0][1]
-   
-    def download(self, email_database):
+
+    def fetch(self, email_identifiers, chunk_size=CHUNK_SIZE, pipeline=PIPELINE, parts=RFC822):
+        '''
+        Fetch many emails by identifier from the selected folder.
+
+        Identifiers are grouped into chunks, each chunk is a single UID FETCH
+        over a compact UID set, and up to `pipeline` of these commands are sent
+        before waiting on the first response, hiding the round trip latency.
+
+        >>> from mailscanner.imapserver import ImapServer
+        >>> server = ImapServer({'INBOX': [b'Subject: %d\\n\\nHello' % uid for uid in range(1, 6)]}, interleave=3)
+        >>> source = MailSource('127.0.0.1', 'user', 'password', port=server.port, ssl=False)
+        >>> source.select('INBOX')[0]
+        1
+        >>> for chunk in source.fetch(['1', '2', '3', '9', '5'], chunk_size=2, pipeline=3):
+        ...     print(chunk)
+        [('1', b'Subject: 1\\n\\nHello'), ('2', b'Subject: 2\\n\\nHello')]
+        [('3', b'Subject: 3\\n\\nHello'), ('9', None)]
+        [('5', b'Subject: 5\\n\\nHello')]
+        >>> server.close()
+
+        Parameters
+        ----------
+        email_identifiers
+            A list of email identification strings.
+        chunk_size
+            Number of emails requested in each UID FETCH.
+        pipeline
+            Number of UID FETCH commands kept in flight.
+        parts
+            What to fetch of each email, the entire email by default, or
+            see `header_fields`.
+
+        Returns
+        -------
+        generator
+            Yields a list of (identifier, body) tuples per chunk, in request order.
+            The body is `None` when the server no longer has that email.
+        '''
+        in_flight = collections.deque()
+        # responses arrive for any command in flight, so are kept by UID until their chunk completes
+        bodies = {}
+        for start in range(0, len(email_identifiers), chunk_size):
+            chunk = email_identifiers[start:start + chunk_size]
+            tag = self.mail._command('UID', 'FETCH', uid_set(chunk), parts)
+            in_flight.append((chunk, tag))
+            if len(in_flight) >= pipeline:
+                yield self._fetched(*in_flight.popleft(), bodies)
+        while in_flight:
+            yield self._fetched(*in_flight.popleft(), bodies)
+
+    def _fetched(self, chunk, tag, bodies):
+        '''
+        Wait for a pipelined UID FETCH to complete, pairing bodies with identifiers.
+
+        Untagged FETCH responses read so far may belong to any command in flight,
+        they all go into `bodies`, and only this chunk's identifiers are taken out.
+        '''
+        typ, data = self.mail._command_complete('UID', tag)
+        if typ != 'OK':
+            raise self.mail.error('UID FETCH failed: {0} {1}'.format(typ, data))
+        _, data = self.mail._untagged_response(typ, data, 'FETCH')
+        bodies.update(fetch_response(data))
+        return [(identifier, bodies.pop(identifier, None)) for identifier in chunk]
+
+    def parallel_fetch(self, folder, email_identifiers, connections, chunk_size=CHUNK_SIZE, pipeline=PIPELINE, parts=RFC822):
+        '''
+        Fetch many emails by identifier, spread across several IMAP sessions.
+
+        Each session is a `clone` running `fetch` in its own thread, pulling
+        work from a shared queue, so faster sessions take on more of the
+        identifiers. Results are funneled back to the calling thread, which
+        is then the single writer to the database. When the caller stops early,
+        say on an error, the workers are stopped and their sessions logged out.
+
+        >>> from mailscanner.imapserver import ImapServer
+        >>> server = ImapServer({'INBOX': [b'Subject: %d\\n\\nHello' % uid for uid in range(1, 9)]})
+        >>> source = MailSource('127.0.0.1', 'user', 'password', port=server.port, ssl=False)
+        >>> identifiers = [str(uid) for uid in range(1, 9)]
+        >>> chunks = source.parallel_fetch('INBOX', identifiers, 2, chunk_size=2, pipeline=1)
+        >>> sorted(identifier for chunk in chunks for identifier, body in chunk if body)
+        ['1', '2', '3', '4', '5', '6', '7', '8']
+        >>> server.commands.count('LOGOUT')
+        2
+        >>> chunks = source.parallel_fetch('INBOX', identifiers, 2, chunk_size=2, pipeline=1)
+        >>> len(next(chunks))
+        2
+        >>> chunks.close()
+        >>> server.commands.count('LOGOUT')
+        4
+        >>> server.close()
+
+        Parameters
+        ----------
+        folder
+            A string naming the folder holding the emails.
+        email_identifiers
+            A list of email identification strings.
+        connections
+            Number of IMAP sessions to use.
+        chunk_size
+            Number of emails requested in each UID FETCH.
+        pipeline
+            Number of UID FETCH commands kept in flight on each session.
+        parts
+            What to fetch of each email, as in `fetch`.
+
+        Returns
+        -------
+        generator
+            Yields a list of (identifier, body) tuples per chunk, in completion order.
+        '''
+        work = queue.Queue()
+        batch = chunk_size * pipeline
+        for start in range(0, len(email_identifiers), batch):
+            work.put(email_identifiers[start:start + batch])
+        # no sense in opening sessions that will find no work
+        connections = min(connections, work.qsize())
+        results = queue.Queue(maxsize=connections * pipeline * 2)
+        # set when the caller stops reading, so workers give up rather than wait on a full queue
+        stop = threading.Event()
+        sources = []
+
+        def put(item):
+            while not stop.is_set():
+                try:
+                    results.put(item, timeout=STOP_POLL)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def worker():
+            try:
+                source = self.clone()
+                sources.append(source)
+                source.mail.select(folder)
+                while not stop.is_set():
+                    try:
+                        identifiers = work.get_nowait()
+                    except queue.Empty:
+                        break
+                    for chunk in source.fetch(identifiers, chunk_size=chunk_size, pipeline=pipeline, parts=parts):
+                        if not put(chunk):
+                            break
+            except Exception as error:
+                put(error)
+            finally:
+                put(None)
+
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(connections)]
+        for thread in workers:
+            thread.start()
+        try:
+            running = len(workers)
+            while running:
+                chunk = results.get()
+                if chunk is None:
+                    running -= 1
+                elif isinstance(chunk, Exception):
+                    raise chunk
+                else:
+                    yield chunk
+        finally:
+            stop.set()
+            # unblock any worker waiting to put, then wait for them all
+            while any(thread.is_alive() for thread in workers):
+                try:
+                    results.get(timeout=STOP_POLL)
+                except queue.Empty:
+                    pass
+            for source in sources:
+                try:
+                    source.mail.logout()
+                except Exception:
+                    # a session broken mid command cannot log out cleanly, it is closed all the same
+                    pass
+
+    def _fetch_all(self, folder, email_identifiers, connections, chunk_size, pipeline, parts):
+        '''
+        Fetch over one, or several, IMAP sessions.
+        '''
+        if connections > 1:
+            return self.parallel_fetch(folder, email_identifiers, connections,
+                                       chunk_size=chunk_size, pipeline=pipeline, parts=parts)
+        return self.fetch(email_identifiers, chunk_size=chunk_size, pipeline=pipeline, parts=parts)
+
+    def link_stored(self, email_database, table, folder, email_identifiers,
+                    chunk_size=CHUNK_SIZE, pipeline=PIPELINE, connections=1):
+        '''
+        Refer identifiers to bodies already stored, say from another folder,
+        by fetching only their Message-ID.
+
+        Returns
+        -------
+        list
+            The identifiers that still need their body downloaded.
+        '''
+        remaining = []
+        chunks = self._fetch_all(folder, email_identifiers, connections, chunk_size, pipeline,
+                                 header_fields(['Message-ID']))
+        for chunk in tqdm(chunks, desc=table, unit='chunk'):
+            keys = [(identifier, body_key(headers)) for identifier, headers in chunk if headers]
+            known = email_database.known_bodies([key for _, key in keys])
+            email_database.save_keys(table, [(identifier, key) for identifier, key in keys if key in known])
+            remaining.extend(identifier for identifier, headers in chunk
+                             if not headers or body_key(headers) not in known)
+        return remaining
+
+    def download(self, email_database, chunk_size=CHUNK_SIZE, pipeline=PIPELINE, connections=1, headers=None):
         '''
         Download all email. This uses a two pass algorithm to allow restart and
         catch up to avoid the pain of downloading every email every time.
@@ -62,46 +403,191 @@ class MailSource:
         Pass 1 - get all identifiers of all email, storing them in the database.
         Pass 2 - for all identifiers without a body, download and store the body in the database.
 
+        Pass 1 is incremental, the database keeps the UIDVALIDITY and last seen
+        identifier of each folder, so only newer identifiers are requested. With
+        CONDSTORE, a folder with an unchanged HIGHESTMODSEQ is not searched at all.
+        A changed UIDVALIDITY invalidates every stored identifier, so the table is
+        emptied and downloaded again from scratch.
+
+        Bodies are fetched in pipelined chunks, see `fetch`, and each chunk is saved
+        in a single transaction, so an interrupted download resumes from the first
+        chunk that was not committed.
+
+        With more than one connection, bodies are fetched over that many
+        IMAP sessions at once, see `parallel_fetch`.
+
+        Email already stored under another folder, matched by Message-ID, is
+        not downloaded again, see `link_stored`.
+
+        Tables named in `headers` skip bodies, fetching just the named header fields
+        into the `email_headers` table, which is a small fraction of the bandwidth
+        and storage. Their bodies are left missing, so a later download without
+        `headers` will fill them in.
+
+        >>> from mailscanner.databases import EmailDatabase
+        >>> from mailscanner.imapserver import ImapServer
+        >>> reply = b'Message-ID: <3@example.com>\\nIn-Reply-To: <1@example.com>\\n\\nHello back'
+        >>> server = ImapServer({
+        ...     'INBOX': [b'Message-ID: <1@example.com>\\n\\nHello', b'Message-ID: <2@example.com>\\n\\nHi', reply],
+        ...     'Sent': [reply]}, interleave=2)
+        >>> class LocalSource(MailSource):
+        ...     FOLDERS = [('all_email', 'INBOX'), ('sent_email', 'Sent')]
+        >>> source = LocalSource('127.0.0.1', 'user', 'password', port=server.port, ssl=False)
+        >>> database = EmailDatabase(':memory:')
+        >>> source.download(database, chunk_size=2)
+        >>> server.commands[2:]
+        ['SELECT INBOX', 'UID SEARCH ALL', 'UID FETCH 1:2 (RFC822)', 'UID FETCH 3 (RFC822)', 'SELECT Sent', 'UID SEARCH ALL', 'UID FETCH 1 (BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])']
+        >>> [identifier for identifier, in database.emails('all_email', columns=('id',))]
+        ['1', '2', '3']
+        >>> list(database.emails('sent_email', columns=('id', 'body')))
+        [('1', 'Message-ID: <3@example.com>\\nIn-Reply-To: <1@example.com>\\n\\nHello back')]
+        >>> database.execute('select count(*) from bodies').fetchone()
+        (3,)
+
+        Downloading again only asks for what is new, and skips unchanged folders.
+
+        >>> server.append('INBOX', b'Message-ID: <4@example.com>\\n\\nAgain')
+        4
+        >>> del server.commands[:]
+        >>> source.download(database)
+        >>> server.commands
+        ['SELECT INBOX', 'UID SEARCH UID 4:*', 'UID FETCH 4 (BODY.PEEK[HEADER.FIELDS (MESSAGE-ID)])', 'UID FETCH 4 (RFC822)', 'SELECT Sent']
+
+        A folder with a new UIDVALIDITY is downloaded from scratch.
+
+        >>> server.create('Sent')
+        >>> server.append('Sent', b'Message-ID: <5@example.com>\\n\\nNew')
+        1
+        >>> source.download(database)
+        >>> list(database.emails('sent_email', columns=('id', 'body')))
+        [('1', 'Message-ID: <5@example.com>\\n\\nNew')]
+        >>> server.close()
+
         Parameters
         ----------
         email_database
             An `EmailDatabase` instance. Email content will be stored here.
+        chunk_size
+            Number of emails requested in each UID FETCH.
+        pipeline
+            Number of UID FETCH commands kept in flight.
+        connections
+            Number of IMAP sessions used to fetch bodies.
+        headers
+            A dict of table name to a list of header names, say
+            `{'sent_email': REPLY_HEADERS}`, fetching only those headers for that table.
         '''
-
-        sources = [('all_email', self.all),
-                   ('sent_email', self.sent)]
-        for table, source in sources:
+        for table, folder in self.FOLDERS:
             # pass 1 -- identifiers
-            cursor = email_database.cursor()
-            identity_save = '''
-                insert or ignore into {0} (id, body)
-                values (?, null)
-            '''.format(table)
-
-            for identifier in tqdm(source(), desc=table, unit='id'):
-                cursor.execute(identity_save, (identifier.decode('utf8'),))
-            email_database.commit()
-
-            # pass 2 -- fill in email
-            cursor = email_database.cursor()
-            identity_read = '''
-                select id from {0}
-                where body is null
-            '''.format(table)
-            email_save = '''
-                update {0}
-                set body = ?
-                where id = ?
-            '''.format(table)
-            cursor.execute(identity_read)
-            for row in tqdm(cursor.fetchall(), desc=table, unit='email'):
-                identifier = row[0]
-                body = self[identifier]
-                try:
-                    cursor.execute(email_save, (body.decode('utf8'), identifier))
-                except UnicodeDecodeError:
-                    cursor.execute(email_save, ('', identifier))
-                email_database.commit()
+            uidvalidity, modseq = self.select(folder)
+            state = email_database.sync_state(folder)
+            if state and state[0] != uidvalidity:
+                # identifiers are no longer valid, start over
+                email_database.clear(table)
+                state = None
+            last_uid = state[1] if state else 0
+            if state and modseq is not None and state[2] == modseq:
+                identifiers = []
+            else:
+                identifiers = self.search(since=last_uid)
+            email_database.save_identifiers(
+                table, (identifier.decode('utf8') for identifier in tqdm(identifiers, desc=table, unit='id')))
+            last_uid = max([last_uid] + [int(identifier) for identifier in identifiers])
+            email_database.save_sync_state(folder, uidvalidity, last_uid, modseq)
+
+            # pass 2 -- fill in email, or just the asked for headers
+            fields = (headers or {}).get(table)
+            if fields:
+                parts = header_fields(fields)
+                identifiers = email_database.missing_headers(table)
+                save = functools.partial(email_database.save_headers, table)
+            else:
+                parts = RFC822
+                identifiers = email_database.missing_bodies(table)
+                if identifiers and email_database.has_bodies():
+                    identifiers = self.link_stored(email_database, table, folder, identifiers,
+                                                   chunk_size=chunk_size, pipeline=pipeline, connections=connections)
+                save = functools.partial(email_database.save_bodies, table)
+            chunks = self._fetch_all(folder, identifiers, connections, chunk_size, pipeline, parts)
+            progress = tqdm(total=len(identifiers), desc=table, unit='email')
+            started = time.time()
+            downloaded = 0
+            for chunk in chunks:
+                # one transaction per chunk
+                # email missing from the response is left without a body, so the next download asks again
+                rows = [(identifier, body) for identifier, body in chunk if body is not None]
+                if rows:
+                    save(rows, batch_size=len(rows))
+                downloaded += sum(len(body) for _, body in rows)
+                progress.update(len(chunk))
+                progress.set_postfix(MBps='{0:.2f}'.format(downloaded / 2**20 / (time.time() - started)))
+            progress.close()
+
+
+def uid_set(email_identifiers):
+    '''
+    Compress identifiers into an IMAP UID set, runs of consecutive
+    identifiers become ranges.
+
+    >>> uid_set(['1', '2', '3', '7', '9', '10'])
+    '1:3,7,9:10'
+    >>> uid_set(['10', '9', '1'])
+    '1,9:10'
+    >>> uid_set([])
+    ''
+    '''
+    uids = sorted(int(identifier) for identifier in email_identifiers)
+    ranges = []
+    for uid in uids:
+        if ranges and ranges[-1][1] + 1 == uid:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(
+        str(low) if low == high else '{0}:{1}'.format(low, high)
+        for low, high in ranges)
+
+
+def header_fields(names):
+    '''
+    FETCH just the named headers, without marking the email as seen.
+
+    >>> header_fields(['Message-ID', 'In-Reply-To'])
+    '(BODY.PEEK[HEADER.FIELDS (MESSAGE-ID IN-REPLY-TO)])'
+    '''
+    return '(BODY.PEEK[HEADER.FIELDS ({0})])'.format(' '.join(name.upper() for name in names))
+
+
+def fetch_response(data):
+    '''
+    Map a multi message UID FETCH response from imaplib to a dict of
+    identifier to body bytes.
+
+    The UID may be reported before or after the body literal, so both
+    positions are checked.
+
+    >>> fetch_response([(b'1 (UID 7 RFC822 {5}', b'hello'), b')'])
+    {'7': b'hello'}
+    >>> fetch_response([(b'2 (RFC822 {5}', b'world'), b' UID 8)', None])
+    {'8': b'world'}
+    >>> fetch_response([None])
+    {}
+    '''
+    bodies = {}
+    literal = None
+    for item in data:
+        if isinstance(item, tuple):
+            envelope, literal = item
+            match = FETCH_UID.search(envelope)
+            if match:
+                bodies[match.group(1).decode('utf8')] = literal
+                literal = None
+        elif item and literal is not None:
+            match = FETCH_UID.search(item)
+            if match:
+                bodies[match.group(1).decode('utf8')] = literal
+            literal = None
+    return bodies
 
 
 class GmailSource(MailSource):
@@ -112,6 +598,11 @@ class GmailSource(MailSource):
     'Allow less secure apps' on https://myaccount.google.com/security.
     '''
 
+    ALL_MAIL = '"[Gmail]/All Mail"'
+    SENT_MAIL = '"[Gmail]/Sent Mail"'
+    FOLDERS = [('all_email', ALL_MAIL),
+               ('sent_email', SENT_MAIL)]
+
     def __init__(self, username, password):
         '''
         Connect to gmail via IMAP.
@@ -129,10 +620,221 @@ class GmailSource(MailSource):
         '''
         All inbound email.
         '''
-        return self.identifiers('"[Gmail]/All Mail"')
+        return self.identifiers(self.ALL_MAIL)
 
     def sent(self):
         '''
         Outbound mail you have sent.
         '''
-        return self.identifiers('"[Gmail]/Sent Mail"')
+        return self.identifiers(self.SENT_MAIL)
+
+
+class MailboxSource:
+    '''
+    Import email from local mbox files and Maildir folders, say a Google Takeout
+    archive or a backup, which is far faster than downloading over IMAP.
+
+    mbox files are memory mapped and split on message boundaries, so they are never
+    read into memory whole. Identifiers are the path and offset of each email in an
+    mbox, or the unique file name in a Maildir, so importing again is harmless.
+    Email labeled sent by Google Takeout is also stored as sent email.
+
+    >>> import tempfile
+    >>> from mailscanner.databases import EmailDatabase
+    >>> with tempfile.NamedTemporaryFile(suffix='.mbox', delete=False) as takeout:
+    ...     _ = takeout.write(b'From 1@xxx\\nMessage-ID: <1@example.com>\\nX-Gmail-Labels: Inbox\\nSubject: Sent yesterday\\n\\nHello\\n\\n'
+    ...                       b'From 2@xxx\\nMessage-ID: <2@example.com>\\nX-Gmail-Labels: Sent,Opened\\n\\nHello\\n')
+    >>> database = EmailDatabase(':memory:')
+    >>> MailboxSource([takeout.name]).download(database)
+    >>> database.count('all_email'), database.count('sent_email')
+    (2, 1)
+    >>> [identifier.rsplit(':', 1)[1] for identifier, in database.execute('select id from sent_email')]
+    ['93']
+    '''
+
+    def __init__(self, paths, table='all_email'):
+        '''
+        Parameters
+        ----------
+        paths
+            A list of mbox file and Maildir folder paths.
+        table
+            The email table to import into, say 'sent_email' for a sent Maildir.
+        '''
+        self.paths = paths
+        self.table = table
+
+    def messages(self, path):
+        '''
+        All emails in a single mbox file or Maildir folder.
+
+        Returns
+        -------
+        generator
+            Yields (identifier, RFC822 bytes) tuples.
+        '''
+        if os.path.isdir(path):
+            return maildir_messages(path)
+        return (('{0}:{1}'.format(path, offset), body) for offset, body in mbox_messages(path))
+
+    def download(self, email_database, jobs=1, batch_size=BATCH_SIZE):
+        '''
+        Import all email into the database with the bulk write path, a batch
+        per transaction.
+
+        Splitting mailboxes into emails is cheap, and is done here. Keying, parsing
+        headers and compressing each batch is most of the work, and with `jobs`
+        above one runs in that many processes, leaving just the writes to the
+        single database connection.
+
+        Parameters
+        ----------
+        email_database
+            An `EmailDatabase` instance. Email content will be stored here.
+        jobs
+            Number of processes keying and compressing email.
+        batch_size
+            Emails written per transaction.
+        '''
+        messages = itertools.chain.from_iterable(self.messages(path) for path in self.paths)
+        batches = iter(lambda: list(itertools.islice(messages, batch_size)), [])
+        progress = tqdm(desc=self.table, unit='email')
+
+        def save(keyed, sent):
+            email_database.save_identifiers(self.table, [identifier for identifier, _, _, _ in keyed], batch_size=len(keyed))
+            email_database.save_keyed(self.table, keyed)
+            if sent:
+                email_database.save_identifiers('sent_email', [identifier for identifier, _, _, _ in sent], batch_size=len(sent))
+                email_database.save_keyed('sent_email', sent)
+            progress.update(len(keyed))
+
+        if jobs > 1:
+            with multiprocessing.Pool(jobs, initializer=_open_codec, initargs=(email_database.codec,)) as pool:
+                # a few batches in flight per process, taken back in order
+                pending = collections.deque()
+                for batch in batches:
+                    pending.append(pool.apply_async(_keyed, (batch, self.table != 'sent_email')))
+                    if len(pending) > jobs * 2:
+                        save(*pending.popleft().get())
+                while pending:
+                    save(*pending.popleft().get())
+        else:
+            for batch in batches:
+                save(*_keyed(batch, self.table != 'sent_email', email_database.codec))
+        progress.close()
+
+
+def _open_codec(codec):
+    '''
+    Remember the database codec in a worker process.
+    '''
+    global _CODEC
+    _CODEC = codec
+
+
+def _keyed(batch, find_sent, codec=None):
+    '''
+    Key, index and compress a batch of imported email, see `keyed_bodies`.
+
+    Parameters
+    ----------
+    batch
+        A list of (identifier, RFC822 bytes) tuples.
+    find_sent
+        Also pick out email Google Takeout labels as sent.
+    codec
+        Compress with this codec, defaults to the one given to this worker process.
+
+    Returns
+    -------
+    tuple
+        Keyed tuples for every email, and for just the sent email.
+    '''
+    keyed = keyed_bodies(batch, codec or _CODEC)
+    sent = [row for row, (_, body) in zip(keyed, batch) if find_sent and TAKEOUT_SENT.search(headers_of(body))]
+    return keyed, sent
+
+
+def mbox_messages(path):
+    '''
+    Split an mbox file into emails, by memory mapping the file and searching
+    for the `From ` line that begins each email.
+
+    Returns
+    -------
+    generator
+        Yields (offset, RFC822 bytes) for each email, less the `From ` line.
+
+    >>> import tempfile
+    >>> def mbox(data):
+    ...     with tempfile.NamedTemporaryFile(suffix='.mbox', delete=False) as mbox:
+    ...         _ = mbox.write(data)
+    ...     return list(mbox_messages(mbox.name))
+    >>> mbox(b'From a\\nSubject: one\\n\\nHello\\n\\nFrom b\\nSubject: two\\n\\nBye\\n\\n')
+    [(0, b'Subject: one\\n\\nHello\\n'), (28, b'Subject: two\\n\\nBye\\n')]
+
+    Anything before the first `From ` line is not an email, and line endings are
+    kept as they are.
+
+    >>> mbox(b'saved by a mail client\\nFrom a\\nSubject: one\\n\\nHello\\n')
+    [(23, b'Subject: one\\n\\nHello\\n')]
+    >>> mbox(b'From a\\r\\nSubject: one\\r\\n\\r\\nHello\\r\\n\\r\\nFrom b\\r\\nSubject: two\\r\\n\\r\\nBye\\r\\n')
+    [(0, b'Subject: one\\r\\n\\r\\nHello\\r\\n'), (33, b'Subject: two\\r\\n\\r\\nBye\\r\\n')]
+    >>> mbox(b''), mbox(b'no email here\\n')
+    ([], [])
+    '''
+    with open(path, 'rb') as mbox:
+        if os.fstat(mbox.fileno()).st_size == 0:
+            return
+        with mmap.mmap(mbox.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:5] == b'From ':
+                start = 0
+            else:
+                start = mapped.find(b'\nFrom ') + 1
+                if not start:
+                    return
+            while True:
+                end = mapped.find(b'\nFrom ', start)
+                stop = len(mapped) if end < 0 else end + 1
+                body = mapped.find(b'\n', start, stop) + 1 or stop
+                message = mapped[body:stop]
+                # the blank line before the next `From ` separates, it is not part of the email
+                if message.endswith(b'\r\n\r\n'):
+                    message = message[:-2]
+                elif message.endswith(b'\n\n'):
+                    message = message[:-1]
+                yield start, message
+                if end < 0:
+                    break
+                start = end + 1
+
+
+def maildir_messages(path):
+    '''
+    Read each email in a Maildir folder.
+
+    Returns
+    -------
+    generator
+        Yields (unique name, RFC822 bytes) for each email.
+
+    Email still being delivered, in `tmp`, is skipped.
+
+    >>> import tempfile
+    >>> maildir = tempfile.mkdtemp()
+    >>> for folder, name, body in [('cur', '2.host:2,S', b'Subject: two'), ('new', '1.host', b'Subject: one'),
+    ...                            ('tmp', '3.host', b'Subject: three')]:
+    ...     os.makedirs(os.path.join(maildir, folder), exist_ok=True)
+    ...     with open(os.path.join(maildir, folder, name), 'wb') as message:
+    ...         _ = message.write(body)
+    >>> list(maildir_messages(maildir))
+    [('2.host', b'Subject: two'), ('1.host', b'Subject: one')]
+    '''
+    for folder in ['cur', 'new']:
+        folder = os.path.join(path, folder)
+        if not os.path.isdir(folder):
+            continue
+        for name in sorted(os.listdir(folder)):
+            with open(os.path.join(folder, name), 'rb') as message:
+                # flags follow the colon, and change as email is read
+                yield name.split(':')[0], message.read()
@@ -19,7 +19,7 @@ setup(
     description='Tools for machine learning email',
     license='BSD 3-Clause License',
     packages=find_packages(),
-    scripts=['bin/download-gmail', 'bin/prepare-replies-dataset', 'bin/prepare-replies-model'],
+    scripts=['bin/download-gmail', 'bin/import-mailbox', 'bin/prepare-replies-dataset', 'bin/prepare-replies-model'],
     install_requires=[
         'tqdm',
         'docopt',